@@ -0,0 +1,409 @@
+"""
+Benchmark harness for the trivia API.
+
+Seeds a synthetic question bank of each requested size, then drives every
+route through the Flask test client and through a concurrent HTTP load
+generator, reporting p50/p95/p99 latency, requests per second and peak
+RSS, and times cold starts (import, create_app() and first request) in
+fresh interpreters. Results are written as JSON so runs can be compared
+across commits:
+
+    python benchmark.py --sizes 1000,100000 --output before.json
+    python benchmark.py --sizes 1000,100000 --output after.json \\
+        --compare before.json
+
+The target database is WIPED and reseeded for every size. By default a
+temporary SQLite file is used; pass --database-url to benchmark a local
+PostgreSQL database created for the purpose.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from flask import jsonify
+
+from flaskr import create_app
+from flaskr.bulk import insert_rows
+from flaskr.serialization import dumps, question_dicts, question_query
+from models import db, Category, Question, notify_question_change
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+WORDS = ('what which who where when title river capital painter element '
+         'planet team invented discovered largest smallest first famous '
+         'country ocean author novel film record year').split()
+SEED_BATCH_SIZE = 5000
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def synthetic_question(rng):
+    words = rng.sample(WORDS, 6)
+    return {
+        'question': ' '.join(words).capitalize() + '?',
+        'answer': rng.choice(WORDS).capitalize(),
+        'category': rng.randint(1, len(CATEGORIES)),
+        'difficulty': rng.randint(1, 5)
+    }
+
+
+def seed(app, size, rng):
+    """Recreate the schema and load `size` synthetic questions."""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for category in CATEGORIES:
+            db.session.add(Category(category))
+        db.session.commit()
+        remaining = size
+        while remaining:
+            batch = min(remaining, SEED_BATCH_SIZE)
+            insert_rows([synthetic_question(rng) for _ in range(batch)])
+            db.session.commit()
+            remaining -= batch
+        notify_question_change('reset')
+
+
+def scenarios(size, rng):
+    """(name, method, path, json body) factories, one per route."""
+    pages = max(1, size // 10)
+    return {
+        'GET /categories':
+            lambda: ('GET', '/categories', None),
+        'GET /questions?page':
+            lambda: ('GET', f'/questions?page={rng.randint(1, pages)}', None),
+        'GET /questions?after_id':
+            lambda: ('GET', f'/questions?after_id={rng.randint(0, size)}',
+                     None),
+        'GET /categories/<id>/questions':
+            lambda: ('GET',
+                     f'/categories/{rng.randint(0, len(CATEGORIES) - 1)}'
+                     '/questions', None),
+        'POST /search':
+            lambda: ('POST', '/search', {'searchTerm': rng.choice(WORDS)}),
+        'POST /quiz':
+            lambda: ('POST', '/quiz', {
+                'quiz_category': {'id': rng.randint(0, len(CATEGORIES))},
+                'previous_questions': [rng.randint(1, size) for _ in range(5)]
+            }),
+        'POST /quiz/sessions':
+            lambda: ('POST', '/quiz/sessions', {
+                'quiz_category': {'id': rng.randint(1, len(CATEGORIES))}
+            }),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarise(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'rps': len(latencies) / elapsed if elapsed else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def run_test_client(app, make_request, count):
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        method, path, body = make_request()
+        before = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        latencies.append((time.perf_counter() - before) * 1000)
+        if response.status_code >= 500:
+            errors += 1
+    return summarise(latencies, errors, time.perf_counter() - started)
+
+
+def run_http(port, make_request, count, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_worker = [count // concurrency] * concurrency
+    per_worker[0] += count % concurrency
+
+    def worker(requests):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        local = []
+        failed = 0
+        for _ in range(requests):
+            with lock:
+                method, path, body = make_request()
+            headers = {}
+            payload = None
+            if body is not None:
+                payload = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            before = time.perf_counter()
+            try:
+                connection.request(method, path, payload, headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 500:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+            local.append((time.perf_counter() - before) * 1000)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, per_worker))
+    return summarise(latencies, errors[0], time.perf_counter() - started)
+
+
+def run_serialization(app, category, repeats):
+    """Time serialising one category listing through both read paths.
+
+    Compares the ORM path (Question instances, format(), jsonify) with the
+    lean path (column tuples, question_dicts(), serialization.dumps).
+    """
+    def orm_path():
+        questions = Question.query.filter(Question.category == category) \
+            .order_by(Question.id).all()
+        return jsonify({
+            'questions': [question.format() for question in questions]
+        }).get_data()
+
+    def lean_path():
+        questions = question_dicts(
+            question_query().filter(Question.category == category)
+            .order_by(Question.id)
+        )
+        return dumps({'questions': questions})
+
+    results = {}
+    with app.test_request_context():
+        assert orm_path() == lean_path()
+        for name, path in (('serialize format()+jsonify', orm_path),
+                           ('serialize columns+dumps', lean_path)):
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(repeats):
+                before = time.perf_counter()
+                path()
+                latencies.append((time.perf_counter() - before) * 1000)
+                db.session.remove()
+            results[name] = summarise(
+                latencies, 0, time.perf_counter() - started)
+    return results
+
+
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+booted = time.perf_counter()
+app.test_client().get('/categories')
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': booted - imported,
+    'first request': served - booted,
+}))
+"""
+
+
+def run_startup(database_url, repeats):
+    """Time a cold start in fresh interpreters.
+
+    Each repeat runs STARTUP_PROBE in a new process and reports how long
+    importing flaskr, calling create_app() and serving the first request
+    took.
+    """
+    timings = {}
+    started = time.perf_counter()
+    for _ in range(repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_PROBE, database_url],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        for phase, seconds in json.loads(output).items():
+            timings.setdefault(phase, []).append(seconds * 1000)
+    elapsed = time.perf_counter() - started
+    return {
+        f'startup {phase}': summarise(latencies, 0, elapsed)
+        for phase, latencies in timings.items()
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {
+            (r['size'], r['driver'], r['route']): r
+            for r in json.load(f)['results']
+        }
+    print(f'\ncompared with {baseline_path}:')
+    for result in results:
+        key = (result['size'], result['driver'], result['route'])
+        before = baseline.get(key)
+        if not before or not before['p95_ms'] or not result['p95_ms']:
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms']
+        print(f'{result["size"]:>9} {result["driver"]:<11} '
+              f'{result["route"]:<32} p95 {before["p95_ms"]:8.2f} -> '
+              f'{result["p95_ms"]:8.2f} ms ({change:+.0%})')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--database-url',
+                        help='database to WIPE and seed '
+                             '(default: a temporary SQLite file)')
+    parser.add_argument('--sizes', default='1000',
+                        help='comma separated question bank sizes')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route and driver')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent HTTP clients')
+    parser.add_argument('--drivers', default='test_client,http',
+                        help='comma separated: test_client, http')
+    parser.add_argument('--routes',
+                        help='comma separated route names to run '
+                             '(default: all)')
+    parser.add_argument('--serialization-repeats', type=int, default=20,
+                        help='repeats of the in-process serialisation '
+                             'comparison (0 to skip)')
+    parser.add_argument('--startup-repeats', type=int, default=5,
+                        help='cold starts to time in fresh interpreters '
+                             '(0 to skip)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='earlier JSON output to diff')
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url
+    if database_url is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database_url = f'sqlite:///{path}'
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+    drivers = args.drivers.split(',')
+    results = []
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        seed(app, size, rng)
+        print(f'seeded {size} questions in '
+              f'{time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+        routes = scenarios(size, rng)
+        if args.routes:
+            routes = {name: routes[name] for name in args.routes.split(',')}
+
+        server = None
+        if 'http' in drivers:
+            server = make_server('127.0.0.1', 0, app, threaded=True,
+                                 request_handler=QuietRequestHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        for name, make_request in routes.items():
+            for driver in drivers:
+                if driver == 'http':
+                    summary = run_http(server.port, make_request,
+                                       args.requests, args.concurrency)
+                else:
+                    summary = run_test_client(app, make_request,
+                                              args.requests)
+                result = dict(size=size, driver=driver, route=name, **summary)
+                results.append(result)
+                print(f'{size:>9} {driver:<11} {name:<32} '
+                      f'p50 {result["p50_ms"]:8.2f} '
+                      f'p95 {result["p95_ms"]:8.2f} '
+                      f'p99 {result["p99_ms"]:8.2f} ms '
+                      f'{result["rps"]:9.1f} req/s')
+
+        if server is not None:
+            server.shutdown()
+
+        if args.serialization_repeats:
+            timings = run_serialization(app, 1, args.serialization_repeats)
+            for name, summary in timings.items():
+                result = dict(size=size, driver='in_process', route=name,
+                              **summary)
+                results.append(result)
+                print(f'{size:>9} {"in_process":<11} {name:<32} '
+                      f'p50 {result["p50_ms"]:8.2f} '
+                      f'p95 {result["p95_ms"]:8.2f} '
+                      f'p99 {result["p99_ms"]:8.2f} ms')
+
+    if args.startup_repeats:
+        for name, summary in run_startup(database_url,
+                                         args.startup_repeats).items():
+            result = dict(size=size, driver='process', route=name, **summary)
+            results.append(result)
+            print(f'{size:>9} {"process":<11} {name:<32} '
+                  f'p50 {result["p50_ms"]:8.2f} '
+                  f'p95 {result["p95_ms"]:8.2f} '
+                  f'p99 {result["p99_ms"]:8.2f} ms')
+
+    output = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'database': database_url.split(':', 1)[0],
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'requests': args.requests,
+            'concurrency': args.concurrency
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'wrote {args.output}', file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
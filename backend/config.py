@@ -0,0 +1,78 @@
+import os
+
+from models import database_path
+
+"""
+Config
+    default settings for create_app(). Pass a subclass, an instance or a
+    dict with any of these keys as create_app(test_config) to override
+    them; DATABASE_URL and DATABASE_REPLICA_URL are read from the
+    environment.
+"""
+class Config:
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', database_path)
+
+    # connection pool, per worker process (ignored for SQLite)
+    DATABASE_POOL_SIZE = 5
+    DATABASE_MAX_OVERFLOW = 10
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_PRE_PING = True
+
+    # PostgreSQL only
+    DATABASE_CONNECT_TIMEOUT = 10
+    DATABASE_STATEMENT_TIMEOUT_MS = None
+
+    # run db.create_all() in setup_db(); off so that booting a worker
+    # issues no DDL (use `python migrations.py upgrade` instead)
+    SCHEMA_CREATE = os.environ.get('SCHEMA_CREATE', '').lower() \
+        in ('1', 'true', 'yes')
+
+    # deleting a question only stamps questions.deleted_at; the rows are
+    # removed in batches by the purge_deleted job (flaskr.jobs)
+    SOFT_DELETE = os.environ.get('SOFT_DELETE', '').lower() \
+        in ('1', 'true', 'yes')
+
+    # read replica used for GET requests
+    DATABASE_REPLICA_URI = os.environ.get('DATABASE_REPLICA_URL')
+
+    METRICS_ENABLED = False
+    SLOW_REQUEST_MS = None
+    SEARCH_BACKEND = None
+
+    # response cache: 'local', 'redis' or a flaskr.cache.CacheBackend
+    CACHE_BACKEND = None
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+
+    # admission control, keyed by route rule (see flaskr.admission):
+    # {'/search': (tokens per second, burst)} per client address and
+    # {'/search': (requests in flight, requests queued)} per process
+    RATE_LIMITS = None
+    CONCURRENCY_LIMITS = None
+    CONCURRENCY_QUEUE_TIMEOUT = 1.0
+    RATE_LIMIT_STORE = None
+
+    # seconds between batched writes of quiz results (flaskr.leaderboard)
+    RESULTS_FLUSH_INTERVAL = 1.0
+
+    # seconds between bulk writes of per-question answer counts
+    # (flaskr.answer_stats)
+    ANSWER_STATS_FLUSH_INTERVAL = 10.0
+
+    # background jobs (flaskr.jobs): the SQLite file holding the queue
+    # (default: jobs.db in the instance folder), threads started in every
+    # app process to run them (0: only queue them and run `python
+    # worker.py` instead), and retries of failed jobs
+    JOBS_DATABASE = os.environ.get('JOBS_DATABASE')
+    JOBS_WORKERS = 0
+    JOBS_MAX_ATTEMPTS = 3
+    JOBS_RETRY_DELAY = 5.0
+
+    # read-only serving from a question snapshot (flaskr.snapshot): when
+    # SNAPSHOT_PATH is set create_app() maps that file instead of opening
+    # the database, and checks it for a new version every
+    # SNAPSHOT_CHECK_INTERVAL seconds. The export_snapshot job writes to
+    # SNAPSHOT_EXPORT_PATH (default: snapshot.bin in the instance folder).
+    SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+    SNAPSHOT_CHECK_INTERVAL = 1.0
+    SNAPSHOT_EXPORT_PATH = os.environ.get('SNAPSHOT_EXPORT_PATH')
@@ -1,19 +1,148 @@
 from math import ceil
 import traceback
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, Response, \
+    stream_with_context, url_for
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
+from config import Config
+from models import setup_db, Question, question_count, category_registry
+from .question_index import question_index, target_difficulty
+from .quiz_sessions import QuizSessionStore
+from .leaderboard import leaderboard, record_result, result_buffer
+from .answer_stats import answer_stats, SERVED, CORRECT, WRONG
+from .search import get_search_backend
+from .cache import ResponseCache, LocalCacheBackend, get_cache_backend
+from .admission import AdmissionControl
+from .metrics import metrics, record_rows
+from .serialization import json_response, question_query, question_dicts
+from .streaming import stream_mode, stream_questions, stream_rows, \
+    batched, peek
+from .bulk import create_questions, import_questions, export_questions, \
+    delete_questions, read_csv, read_ndjson
+from .jobs import jobs, job_types
+from .snapshot import snapshot_routes
 
 QUESTIONS_PER_PAGE = 10
 
 
+def paginate_questions(page, per_page=QUESTIONS_PER_PAGE):
+    """Fetch a single page of questions with LIMIT/OFFSET."""
+    return question_dicts(
+        question_query().order_by(Question.id)
+        .offset((page - 1) * per_page)
+        .limit(per_page)
+    )
+
+
+def questions_by_id(question_ids):
+    """Load questions by id, keeping the order of `question_ids`."""
+    if not question_ids:
+        return []
+    questions = {
+        question['id']: question
+        for question in question_dicts(
+            question_query().filter(Question.id.in_(question_ids))
+        )
+    }
+    return [questions[i] for i in question_ids if i in questions]
+
+
+def questions_after(after_id, per_page=QUESTIONS_PER_PAGE):
+    """Fetch the page of questions following `after_id` (keyset cursor).
+
+    Unlike OFFSET, the cost of this query does not grow with page depth
+    because it seeks straight to `after_id` on the primary key index.
+    """
+    return question_dicts(
+        question_query().filter(Question.id > after_id)
+        .order_by(Question.id)
+        .limit(per_page)
+    )
+
+
+def register_error_handlers(app):
+    """JSON error responses, shared by the database and snapshot apps."""
+    @app.errorhandler(404)
+    def not_found(error):
+        return jsonify({
+            'success': False,
+            'error': 404,
+            'message': 'resource not found'
+        }), 404
+
+    @app.errorhandler(405)
+    def unallowed(error):
+        return jsonify({
+            'success': False,
+            'error': 405,
+            'message': 'method not allowed'
+        }), 405
+
+    @app.errorhandler(422)
+    def unprocessable(error):
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable'
+        }), 422
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'bad request'
+        })
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'too many requests'
+        }), 429, {'Retry-After': str(getattr(error, 'retry_after', 1))}
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'service unavailable'
+        }), 503, {'Retry-After': str(getattr(error, 'retry_after', 1))}
+
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_object(Config)
+    if isinstance(test_config, dict):
+        app.config.from_mapping(test_config)
+    elif test_config is not None:
+        app.config.from_object(test_config)
+
+    if app.config.get('SNAPSHOT_PATH'):
+        # read-only node: served from the snapshot file, no database
+        metrics.init_app(app)
+        CORS(app, resources={r'/api/*': {'origins': '*'}})
+        AdmissionControl(app, get_cache_backend(app.config))
+        snapshot_routes(app)
+        register_error_handlers(app)
+        return app
+
+    setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+    metrics.init_app(app)
+    result_buffer.init_app(app)
+    answer_stats.init_app(app)
+    jobs.init_app(app)
     CORS(app, resources={r'/api/*': {'origins': '*'}})
+    response_cache = ResponseCache(get_cache_backend(app.config))
+    AdmissionControl(app, response_cache.backend)
+    # quiz sessions are shared through the cache backend unless it is the
+    # per-process LRU, where they get an LRU of their own
+    quiz_sessions = QuizSessionStore(
+        None if isinstance(response_cache.backend, LocalCacheBackend)
+        else response_cache.backend
+    )
 
     """
     @DONE: Set up CORS. Allow '*' for origins.
@@ -45,18 +174,41 @@ def create_app(test_config=None):
     for all available categories.
     """
     @app.route('/categories')
+    @response_cache.cached
     def get_categories():
-        categories = Category.query.all()
+        formatted_categories = category_registry.ids()
 
-        if not categories:
+        if not formatted_categories:
             abort(404)
 
-        formatted_categories = [category.id for category in categories]
         return jsonify({
             'success': True,
             'categories': formatted_categories
         })
 
+    @app.route('/categories/summary')
+    @response_cache.cached
+    def get_categories_summary():
+        counts = question_index.category_counts()
+
+        summary = [
+            {
+                'id': category_id,
+                'type': category_registry.type_of(category_id),
+                'total_questions': counts.get(category_id, 0),
+                'difficulties': question_index.difficulty_histogram(category_id)
+            }
+            for category_id in category_registry.ids()
+        ]
+        if not summary:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'categories': summary,
+            'total_questions': question_index.count()
+        })
+
     """
     @DONE:
     Create an endpoint to handle GET requests for questions,
@@ -72,31 +224,46 @@ def create_app(test_config=None):
     """
 
     @app.route('/questions')
+    @response_cache.cached
     def get_questions():
         page = request.args.get('page', 1, type=int)
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
+        after_id = request.args.get('after_id', type=int)
 
-        questions = Question.query.all()
-        if not questions:
+        total_questions = question_count()
+        if not total_questions:
             abort(404)
-            
-        formatted_questions = [question.format() for question in questions]
 
-        max_page = ceil(len(formatted_questions) / QUESTIONS_PER_PAGE)
-        if page > max_page:
-            abort(404)
+        if after_id is not None:
+            questions = questions_after(after_id)
+            if not questions:
+                abort(404)
+        else:
+            max_page = ceil(total_questions / QUESTIONS_PER_PAGE)
+            if page < 1 or page > max_page:
+                abort(404)
+            questions = paginate_questions(page)
 
-        categories = Category.query.all()
-        formatted_categories = [category.id for category in categories]
+        for question in questions:
+            question['empirical_difficulty'] = answer_stats.difficulty(
+                question['id'], question['difficulty'])
 
-        return jsonify({
+        formatted_categories = category_registry.ids()
+        record_rows(returned=len(questions))
+
+        response = {
             'success': True,
-            'questions': formatted_questions[start:end],
-            'total_questions': len(formatted_questions),
+            'questions': questions,
+            'total_questions': total_questions,
             'categories': formatted_categories,
-            # 'current_category': categories[questions[start].category].type
-        })
+            'current_category':
+                category_registry.type_of(questions[0]['category'])
+        }
+        if after_id is not None:
+            response['next_after_id'] = \
+                questions[-1]['id'] \
+                if len(questions) == QUESTIONS_PER_PAGE else None
+
+        return json_response(response)
 
     """
     @DONE:
@@ -112,7 +279,8 @@ def create_app(test_config=None):
 
         # try:
         question = Question.query.filter(
-            Question.id == question_id
+            Question.id == question_id,
+            Question.not_deleted()
             ).one_or_none()
 
         if not question:
@@ -129,6 +297,35 @@ def create_app(test_config=None):
         #     traceback.print_exc()
         #     abort(422)
 
+    @app.route('/questions/delete', methods=['POST'])
+    def bulk_delete_questions():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+
+        ids = body.get('ids')
+        filters = body.get('filter') or {}
+        if ids is not None and (
+                not isinstance(ids, list)
+                or not all(isinstance(i, int) for i in ids)):
+            abort(422)
+        if not isinstance(filters, dict) \
+                or set(filters) - {'category', 'difficulty'} \
+                or not all(isinstance(v, int) for v in filters.values()):
+            abort(422)
+        if ids is None and not filters:
+            abort(422)
+
+        deleted = delete_questions(
+            ids, soft=app.config.get('SOFT_DELETE'), **filters
+        )
+
+        return jsonify({
+            'success': True,
+            'deleted': [question['id'] for question in deleted],
+            'total_deleted': len(deleted)
+        })
+
     """
     @DONE:
     Create an endpoint to POST a new question,
@@ -149,12 +346,21 @@ def create_app(test_config=None):
             if request.method == 'POST':
                 if not request.json:
                     abort(422)
+
+                if isinstance(request.json, list):
+                    results = create_questions(request.json)
+                    return jsonify({
+                        'success': True,
+                        'created': sum(r['success'] for r in results),
+                        'results': results
+                    })
+
                 question = request.json['question'].strip()
                 answer = request.json['answer'].strip()
                 difficulty = request.json['difficulty']
                 category = request.json['category']
 
-                total_categories = len(Category.query.all())
+                total_categories = category_registry.count()
                 max_difficulty = 5
 
                 if not (question and answer and difficulty and category):
@@ -193,6 +399,83 @@ def create_app(test_config=None):
             traceback.print_exc()
             abort(422)
 
+    """
+    Bulk import and export of questions. Both directions stream, so the
+    catalogue is never held in memory at once.
+    """
+
+    @app.route('/questions/import', methods=['POST'])
+    def bulk_import_questions():
+        if request.mimetype == 'text/csv':
+            input_format, read = 'csv', read_csv
+        elif request.mimetype in ('application/x-ndjson', 'application/json'):
+            input_format, read = 'ndjson', read_ndjson
+        else:
+            abort(422)
+
+        if request.args.get('background', type=int):
+            return job_accepted(jobs.submit('import', {
+                'upload': jobs.spool(request.stream),
+                'format': input_format
+            }))
+
+        imported, rejected, errors = import_questions(read(request.stream))
+
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'rejected': rejected,
+            'errors': errors
+        })
+
+    @app.route('/questions/export')
+    def bulk_export_questions():
+        output_format = request.args.get('format', 'ndjson')
+        mimetypes = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+        if output_format not in mimetypes:
+            abort(422)
+
+        return Response(
+            stream_with_context(export_questions(output_format)),
+            mimetype=mimetypes[output_format]
+        )
+
+    """
+    Background jobs: maintenance work that is too slow for a request is
+    queued and run by flaskr.jobs; clients poll GET /jobs/<id>.
+    """
+
+    def job_accepted(job):
+        return jsonify({
+            'success': True,
+            'job': job
+        }), 202, {'Location': url_for('get_job', job_id=job['id'])}
+
+    @app.route('/jobs', methods=['POST'])
+    def submit_job():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
+
+        job_type = job_types.get(body.get('type'))
+        params = body.get('params', {})
+        if job_type is None or not job_type.public \
+                or not isinstance(params, dict):
+            abort(422)
+
+        return job_accepted(jobs.submit(body['type'], params))
+
+    @app.route('/jobs/<int:job_id>')
+    def get_job(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'job': job
+        })
+
     """
     @DONE:
     Create a POST endpoint to get questions based on a search term.
@@ -205,6 +488,7 @@ def create_app(test_config=None):
     """
 
     @app.route('/search', methods=['GET', 'POST'])
+    @response_cache.cached
     def search_by_term():
         search_term = None
 
@@ -214,26 +498,47 @@ def create_app(test_config=None):
                     abort(422)
 
                 search_term = request.json['searchTerm']
-                if search_term:
-                    search_results = Question.query.filter(
-                        Question.question.ilike(f'%{search_term}%')
-                        ).all()
-
-                else:
+                page = request.json.get('page', 1)
+                if not search_term or page < 1:
                     abort(422)
 
+                mode = stream_mode()
+                if mode is not None:
+                    first, questions = peek(
+                        question
+                        for batch in batched(
+                            get_search_backend().iter_ids(search_term))
+                        for question in questions_by_id(batch)
+                        )
+                    if first is None:
+                        abort(404)
+                    return stream_questions(
+                        mode,
+                        questions,
+                        head={'current_category':
+                              category_registry.type_of(first['category'])},
+                        tail=lambda count: {'success': True,
+                                            'total_questions': count}
+                        )
+
+                question_ids, total_questions = \
+                    get_search_backend().search(
+                        search_term, page, QUESTIONS_PER_PAGE
+                        )
+                search_results = questions_by_id(question_ids)
+
                 if search_results:
-                    formatted_questions = \
-                        [question.format() for question in search_results]
-                    question_category_id = search_results[0].category
-                    current_category = Category.query.filter(
-                        Category.id == question_category_id
-                        ).first().type
+                    record_rows(returned=len(search_results))
+                    question_category_id = search_results[0]['category']
+                    current_category = category_registry.type_of(
+                        question_category_id
+                        )
 
-                    return jsonify({
+                    return json_response({
                         'success': True,
-                        'questions': formatted_questions,
-                        'total_questions': len(formatted_questions),
+                        'questions': search_results,
+                        'total_questions': total_questions,
+                        'page': page,
                         'current_category': current_category
                     })
 
@@ -257,6 +562,7 @@ def create_app(test_config=None):
     """
 
     @app.route('/categories/<int:category_id>/questions')
+    @response_cache.cached
     def get_questions_by_category(category_id):
 
         try:
@@ -264,22 +570,37 @@ def create_app(test_config=None):
 
             if not category_id:
                 abort(422)
-            questions = Question.query.filter(
-                Question.category == category_id
-                ).all()
-
-            formatted_questions = [question.format() for question in questions]
 
-            if len(questions) == 0:
+            total_questions = question_index.count(category_id)
+            if not total_questions:
                 abort(404)
 
-            categories = Category.query.all()
+            current_category = category_registry.type_of(category_id)
+            if current_category is None:
+                abort(404)
 
-            return jsonify({
+            query = question_query().filter(
+                Question.category == category_id
+                ).order_by(Question.id)
+
+            mode = stream_mode()
+            if mode is not None:
+                return stream_questions(
+                    mode,
+                    stream_rows(query),
+                    head={'current_category': current_category},
+                    tail=lambda count: {'success': True,
+                                        'total_questions': total_questions}
+                    )
+
+            formatted_questions = question_dicts(query)
+            record_rows(returned=len(formatted_questions))
+
+            return json_response({
                 'success': True,
                 'questions': formatted_questions,
-                'total_questions': len(formatted_questions),
-                'current_category': categories[category_id - 1].type
+                'total_questions': total_questions,
+                'current_category': current_category
             })
 
         except Exception as e:
@@ -315,108 +636,177 @@ def create_app(test_config=None):
                 category_id = request.json['quiz_category']['id']
                 previous_questions = request.json['previous_questions']
 
-                if not (category_id or previous_questions):
-                    questions = Question.query.all()
-                    formatted_questions = \
-                        [question.format() for question in questions]
+                target = target_difficulty(
+                    question_index.difficulty_histogram(category_id or None),
+                    target=request.json.get('target_difficulty'),
+                    curve=request.json.get('difficulty_curve'),
+                    streak=request.json.get('streak'),
+                    served=len(previous_questions or ())
+                    )
+
+                question = question_index.random_question(
+                    category_id or None,
+                    exclude=previous_questions or (),
+                    target_difficulty=target
+                    )
+
+                if question is None:
+                    abort(404)
+                answer_stats.record(question.id, SERVED)
+                record_rows(returned=1)
 
-                    if not formatted_questions:
-                        abort(404)
+                response = {
+                    'success': True,
+                    'question': question.format()
+                }
+                if target is not None:
+                    response['target_difficulty'] = target
+                return jsonify(response)
 
-                    return jsonify({
-                        'success': True,
-                        'question': random.choice(formatted_questions)
-                    })
+            else:
+                abort(405)
 
-                if (not category_id) and previous_questions:
+        except Exception as e:
+            print(e)
+            traceback.print_exc()
+            abort(422)
 
-                    db_questions = Question.query.filter(
-                        ~Question.id.in_(previous_questions)
-                        ).all()
+    """
+    Quiz sessions: the server remembers which questions a game has
+    already served, so clients only send the session token instead of
+    the growing previous_questions list.
+    """
 
-                    formatted_questions = \
-                        [question.format() for question in db_questions]
+    @app.route('/quiz/sessions', methods=['POST'])
+    def start_quiz_session():
+        body = request.get_json(silent=True)
+        if body is None:
+            body = {}
+        if not isinstance(body, dict):
+            abort(422)
+        quiz_category = body.get('quiz_category') or {}
+        if not isinstance(quiz_category, dict):
+            abort(422)
+        category_id = quiz_category.get('id')
+        if not isinstance(category_id, (int, str, type(None))):
+            abort(422)
 
-                    if not formatted_questions:
-                        abort(404)
+        token, session = quiz_sessions.start(category_id or None)
+        if not session.remaining:
+            quiz_sessions.end(token)
+            abort(404)
 
-                    return jsonify({
-                        'success': True,
-                        'question': random.choice(formatted_questions)
-                    })
+        return jsonify({
+            'success': True,
+            'session_token': token,
+            'total_questions': session.remaining
+        })
 
-                if (not previous_questions) and category_id:
-                    db_questions = Question.query.filter(
-                        Question.category == category_id
-                        ).all()
+    @app.route('/quiz/sessions/<token>/next', methods=['POST'])
+    def next_quiz_question(token):
+        session, question = quiz_sessions.next_question(token)
+        if session is None or question is None:
+            abort(404)
+        answer_stats.record(question.id, SERVED)
+        record_rows(returned=1)
 
-                    formatted_questions = \
-                        [question.format() for question in db_questions]
+        return jsonify({
+            'success': True,
+            'question': question.format(),
+            'remaining_questions': session.remaining
+        })
 
-                    if not formatted_questions:
-                        abort(404)
+    @app.route('/quiz/sessions/<token>', methods=['DELETE'])
+    def end_quiz_session(token):
+        if not quiz_sessions.end(token):
+            abort(404)
 
-                    return jsonify({
-                        'success': True,
-                        'question': random.choice(formatted_questions)
-                    })
+        return jsonify({
+            'success': True,
+            'deleted': token
+        })
 
-                if category_id and previous_questions:
+    @app.route('/quiz/answers', methods=['POST'])
+    def submit_quiz_answer():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
 
-                    db_questions = Question.query.filter(
-                        ~Question.id.in_(previous_questions)
-                        & (Question.category == category_id)
-                        ).all()
+        question_id = body.get('question_id')
+        correct = body.get('correct')
+        if not isinstance(question_id, int) or not isinstance(correct, bool) \
+                or question_id not in question_index.bucket():
+            abort(422)
 
-                    formatted_questions = \
-                        [question.format() for question in db_questions]
+        answer_stats.record(question_id, CORRECT if correct else WRONG)
 
-                    if not formatted_questions:
-                        abort(404)
+        return jsonify({
+            'success': True,
+            'question_id': question_id,
+            'correct': correct
+        }), 202
 
-                    return jsonify({
-                        'success': True,
-                        'question': random.choice(formatted_questions)
-                    })
+    """
+    Quiz results and leaderboards: results are written to the database in
+    batches in the background, while the top scores are kept in memory.
+    """
 
-            else:
-                abort(405)
+    @app.route('/results', methods=['POST'])
+    def submit_result():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(422)
 
-        except Exception as e:
-            print(e)
-            traceback.print_exc()
+        quiz_category = body.get('quiz_category') or {}
+        if not isinstance(quiz_category, dict):
             abort(422)
+        player = body.get('player')
+        category_id = quiz_category.get('id') or None
+        if not isinstance(category_id, (int, str, type(None))):
+            abort(422)
+        score = body.get('score')
+        total_questions = body.get('total_questions')
 
-    @app.errorhandler(404)
-    def not_found(error):
-        return jsonify({
-            'success': False,
-            'error': 404,
-            'message': 'resource not found'
-        }), 404
+        if not isinstance(player, str) or not player.strip() \
+                or len(player) > 80:
+            abort(422)
+        if not isinstance(score, int) or not isinstance(total_questions, int) \
+                or not 0 <= score <= total_questions:
+            abort(422)
+        if category_id is not None and category_id not in category_registry:
+            abort(422)
 
-    @app.errorhandler(405)
-    def unallowed(error):
-        return jsonify({
-            'success': False,
-            'error': 405,
-            'message': 'method not allowed'
-        }), 405
+        result, rank = record_result(
+            player.strip(),
+            int(category_id) if category_id is not None else None,
+            score,
+            total_questions
+            )
 
-    @app.errorhandler(422)
-    def unprocessable(error):
         return jsonify({
-            'success': False,
-            'error': 422,
-            'message': 'unprocessable'
-        }), 422
+            'success': True,
+            'player': result['player'],
+            'category': result['category'],
+            'score': result['score'],
+            'total_questions': result['total_questions'],
+            'rank': rank
+        }), 202
+
+    @app.route('/leaderboard')
+    def get_leaderboard():
+        category_id = request.args.get('category', type=int) or None
+        limit = request.args.get('limit', 10, type=int)
+        if category_id is not None and category_id not in category_registry:
+            abort(404)
+        if not 1 <= limit <= leaderboard.size:
+            abort(422)
 
-    @app.errorhandler(400)
-    def bad_request(error):
         return jsonify({
-            'success': False,
-            'error': 400,
-            'message': 'bad request'
+            'success': True,
+            'category': category_id,
+            'leaders': leaderboard.top(category_id, limit)
         })
 
+    register_error_handlers(app)
+
     return app
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitStore:
+    """Token buckets keyed by client and route.
+
+    take() removes one token from the bucket `key`, which refills at
+    `rate` tokens per second up to `burst`, and returns 0 when a token was
+    available or else the number of seconds until one will be.
+    """
+
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Buckets for this process only; the least recently used are dropped
+    beyond `max_keys`, which only ever forgives a client."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """Buckets shared by every node, updated atomically by a Lua script."""
+
+    script = """
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local rate, burst, now =
+            tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local tokens = tonumber(bucket[1]) or burst
+        local updated_at = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+        return tostring(wait)
+    """
+
+    def __init__(self, client, prefix='trivia:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key],
+                                args=[rate, burst, time.time()]))
+
+
+class ConcurrencyLimiter:
+    """At most `limit` requests in flight, `queue_size` more waiting.
+
+    acquire() returns False straight away when the queue is full, or after
+    `timeout` seconds in the queue, so overload turns into fast rejections
+    instead of ever longer latency.
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=1.0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.active < self.limit, self.timeout
+                )
+                if admitted:
+                    self.active += 1
+                return admitted
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class AsyncConcurrencyLimiter:
+    """ConcurrencyLimiter for coroutines on one event loop (flaskr.asgi).
+
+    A request that finds the route saturated waits on a future of its
+    own; release() hands its slot straight to the oldest one still
+    waiting.
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=1.0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        return sum(not waiter.done() for waiter in self._waiters)
+
+    async def acquire(self):
+        if self.active < self.limit:
+            self.active += 1
+            return True
+        if self.waiting >= self.queue_size:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return True
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionControl:
+    """Per-client rate limits and per-route concurrency caps.
+
+    RATE_LIMITS maps a route rule (e.g. '/search') to (tokens per second,
+    burst) for each client address; CONCURRENCY_LIMITS maps a route rule
+    to (requests in flight, requests queued) for this worker process.
+    Requests over a rate limit get 429 and requests that find the route
+    saturated get 503, both with a Retry-After header. Buckets live in the
+    store picked by get_rate_limit_store(); if it fails the request is
+    let through.
+
+    Clients are told apart by request.remote_addr, so behind a proxy wrap
+    the app in werkzeug's ProxyFix. The instance is kept in
+    app.extensions['admission'], from which flaskr.asgi applies the same
+    limits to the routes it serves itself.
+    """
+
+    def __init__(self, app=None, cache_backend=None):
+        self.store = None
+        self.rate_limits = {}
+        self.limiters = {}
+        if app is not None:
+            self.init_app(app, cache_backend)
+
+    def init_app(self, app, cache_backend=None):
+        self.rate_limits = dict(app.config.get('RATE_LIMITS') or {})
+        if self.rate_limits:
+            self.store = get_rate_limit_store(app.config, cache_backend)
+        timeout = app.config.get('CONCURRENCY_QUEUE_TIMEOUT', 1.0)
+        self.limiters = {
+            rule: ConcurrencyLimiter(limit, queue_size, timeout)
+            for rule, (limit, queue_size)
+            in (app.config.get('CONCURRENCY_LIMITS') or {}).items()
+        }
+        if self.rate_limits or self.limiters:
+            app.before_request(self._before_request)
+            app.teardown_request(self._teardown_request)
+        app.extensions['admission'] = self
+
+    def rate_limited(self, client, rule):
+        """Take a token for `client` on `rule`; returns 0 if one was left,
+        or else the seconds to send in Retry-After."""
+        if rule not in self.rate_limits:
+            return 0
+        rate, burst = self.rate_limits[rule]
+        try:
+            wait = self.store.take(f'{client}:{rule}', rate, burst)
+        except Exception as e:
+            logger.warning('rate limit store unavailable: %s', e)
+            wait = 0
+        return max(1, math.ceil(wait)) if wait > 0 else 0
+
+    def _before_request(self):
+        if request.url_rule is None or request.method == 'OPTIONS':
+            return
+        rule = request.url_rule.rule
+
+        retry_after = self.rate_limited(request.remote_addr, rule)
+        if retry_after:
+            error = TooManyRequests()
+            error.retry_after = retry_after
+            raise error
+
+        limiter = self.limiters.get(rule)
+        if limiter is not None:
+            if not limiter.acquire():
+                error = ServiceUnavailable()
+                error.retry_after = max(1, math.ceil(limiter.timeout))
+                raise error
+            g.admission_limiter = limiter
+
+    def _teardown_request(self, exception=None):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+
+def get_rate_limit_store(config, cache_backend=None):
+    """Build the store named by RATE_LIMIT_STORE in the app config.
+
+    RATE_LIMIT_STORE may also be a RateLimitStore instance. By default
+    buckets are kept in Redis when the response cache uses Redis (sharing
+    its client) and in memory otherwise.
+    """
+    name = config.get('RATE_LIMIT_STORE')
+    if isinstance(name, RateLimitStore):
+        return name
+    client = getattr(cache_backend, 'client', None)
+    if name is None:
+        name = 'redis' if client is not None else 'memory'
+    if name == 'redis':
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(config['CACHE_REDIS_URL'],
+                                          socket_timeout=1)
+        return RedisRateLimitStore(client)
+    return MemoryRateLimitStore()
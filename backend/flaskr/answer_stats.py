@@ -0,0 +1,225 @@
+import threading
+
+from sqlalchemy import bindparam
+
+from models import db, Question, QuestionStats
+from reloading import ReloadingCache
+from .bulk import MAX_DIFFICULTY
+from .flusher import PeriodicFlusher
+from .streaming import batched
+
+SERVED, CORRECT, WRONG = range(3)
+COUNTS = ('served', 'correct', 'wrong')
+
+
+class CounterShard:
+    """The counts recorded by one thread since the last flush.
+
+    Only the owning thread and the flusher touch a shard, so its lock is
+    never contended between requests.
+    """
+
+    def __init__(self):
+        self.owner = threading.current_thread()
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def drain(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+
+class AnswerStats(PeriodicFlusher, ReloadingCache):
+    """Per-question served/correct/wrong counters and empirical difficulty.
+
+    record() bumps a counter in the calling thread's own shard, so request
+    threads never wait on each other or on the database. Every
+    `flush_interval` seconds (and at exit) the shards are summed and the
+    deltas upserted into question_stats with one statement per 1000
+    questions. Deltas that fail to write are kept for the next flush.
+
+    The totals are read with one query on first use, advanced by each
+    flush and reloaded after `ttl` seconds for other processes' counts,
+    so difficulty() is a dict lookup.
+    """
+
+    name = 'answer-stats'
+    interval_setting = 'ANSWER_STATS_FLUSH_INTERVAL'
+
+    # answers needed before the empirical difficulty replaces the declared
+    # one for quiz selection; also the weight of the declared difficulty
+    min_answers = 20
+
+    def __init__(self, flush_interval=10.0, ttl=300):
+        PeriodicFlusher.__init__(self, flush_interval)
+        ReloadingCache.__init__(self, ttl)
+        self._local = threading.local()
+        self._shards = []
+        self._unwritten = {}
+        self._shards_lock = threading.Lock()
+        self._totals = {}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = CounterShard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def record(self, question_id, outcome):
+        """Count a question as SERVED, or answered CORRECT or WRONG."""
+        shard = self._shard()
+        with shard.lock:
+            counts = shard.counts.get(question_id)
+            if counts is None:
+                counts = shard.counts[question_id] = [0, 0, 0]
+            counts[outcome] += 1
+        self.ensure_worker()
+
+    def _collect(self):
+        """Sum and reset every shard, dropping those of finished threads."""
+        with self._shards_lock:
+            deltas, self._unwritten = self._unwritten, {}
+            shards = []
+            for shard in self._shards:
+                finished = not shard.owner.is_alive()
+                for question_id, counts in shard.drain().items():
+                    total = deltas.setdefault(question_id, [0, 0, 0])
+                    for outcome, count in enumerate(counts):
+                        total[outcome] += count
+                if not finished:
+                    shards.append(shard)
+            self._shards = shards
+        return deltas
+
+    def _write(self, deltas):
+        table = QuestionStats.__table__
+        for question_ids in batched(deltas, 1000):
+            # answers to questions deleted meanwhile are dropped
+            existing = {
+                question_id for question_id, in db.session.query(
+                    Question.id).filter(Question.id.in_(question_ids),
+                                        Question.not_deleted())
+            }
+            rows = [
+                dict(question_id=question_id,
+                     **dict(zip(COUNTS, deltas[question_id])))
+                for question_id in question_ids if question_id in existing
+            ]
+            if not rows:
+                continue
+            if db.engine.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+                statement = insert(table)
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=[table.c.question_id],
+                    set_={
+                        name: table.c[name] + statement.excluded[name]
+                        for name in COUNTS
+                    }
+                ), rows)
+            else:
+                stored = {
+                    question_id for question_id, in db.session.query(
+                        QuestionStats.question_id).filter(
+                        QuestionStats.question_id.in_(existing))
+                }
+                updates = [
+                    dict(delta_id=row['question_id'], **{
+                        f'delta_{name}': row[name] for name in COUNTS
+                    })
+                    for row in rows if row['question_id'] in stored
+                ]
+                if updates:
+                    db.session.execute(
+                        table.update()
+                        .where(table.c.question_id == bindparam('delta_id'))
+                        .values({
+                            name: table.c[name] + bindparam(f'delta_{name}')
+                            for name in COUNTS
+                        }),
+                        updates
+                    )
+                inserts = [row for row in rows
+                           if row['question_id'] not in stored]
+                if inserts:
+                    db.session.execute(table.insert(), inserts)
+        db.session.commit()
+
+    def flush(self):
+        """Write the counts recorded since the last flush."""
+        deltas = self._collect()
+        if not deltas or self.app is None:
+            return 0
+        # holding the reload lock, a reload finds the deltas either in the
+        # table or added to the totals, never both
+        with self._lock:
+            try:
+                with self.app.app_context():
+                    self._write(deltas)
+            except Exception:
+                with self._shards_lock:
+                    for question_id, counts in deltas.items():
+                        total = self._unwritten.setdefault(
+                            question_id, [0, 0, 0])
+                        for outcome, count in enumerate(counts):
+                            total[outcome] += count
+                raise
+            if self._loaded_at is not None:
+                for question_id, counts in deltas.items():
+                    total = self._totals.setdefault(question_id, (0, 0, 0))
+                    self._totals[question_id] = tuple(
+                        a + b for a, b in zip(total, counts)
+                    )
+        return len(deltas)
+
+    def reload(self):
+        rows = db.session.query(
+            QuestionStats.question_id, QuestionStats.served,
+            QuestionStats.correct, QuestionStats.wrong
+            ).all()
+        self._totals = {
+            question_id: (served, correct, wrong)
+            for question_id, served, correct, wrong in rows
+        }
+
+    def counts(self, question_id):
+        """Return (served, correct, wrong) as of the last flush."""
+        self._ensure_loaded()
+        return self._totals.get(question_id, (0, 0, 0))
+
+    def difficulty(self, question_id, declared):
+        """Difficulty on the 1-MAX_DIFFICULTY scale implied by the answers.
+
+        The share of right answers is mapped linearly from 1 (always
+        right) to MAX_DIFFICULTY (always wrong) and blended with the
+        declared difficulty, which counts as `min_answers` answers, so a
+        handful of answers only nudges it.
+        """
+        served, correct, wrong = self.counts(question_id)
+        return self.difficulty_from(declared, correct, wrong)
+
+    def difficulty_from(self, declared, correct, wrong):
+        """difficulty() for answer counts read elsewhere."""
+        if declared is None:
+            declared = (1 + MAX_DIFFICULTY) / 2
+        prior = (MAX_DIFFICULTY - declared) / (MAX_DIFFICULTY - 1)
+        right = (correct + self.min_answers * prior) \
+            / (correct + wrong + self.min_answers)
+        return round(1 + (MAX_DIFFICULTY - 1) * (1 - right), 2)
+
+    def effective_difficulty(self, question_id, declared):
+        """The difficulty quiz selection should use for a question."""
+        served, correct, wrong = self.counts(question_id)
+        return self.effective_from(declared, correct, wrong)
+
+    def effective_from(self, declared, correct, wrong):
+        """effective_difficulty() for answer counts read elsewhere."""
+        if correct + wrong < self.min_answers:
+            return declared
+        return int(round(self.difficulty_from(declared, correct, wrong)))
+
+
+answer_stats = AnswerStats()
@@ -0,0 +1,458 @@
+"""
+ASGI serving mode for the read-heavy trivia routes.
+
+The routes below are served by coroutines on an asyncpg connection pool,
+so a request waiting on PostgreSQL does not hold a worker thread and one
+process can keep thousands of quiz players in flight:
+
+    uvicorn 'flaskr.asgi:create_asgi_app' --factory --workers 4
+
+Every other route (and every route, when run without asyncpg) is handed
+to the regular Flask app through asgiref's WsgiToAsgi, which stays the
+reference implementation. Responses carry the same JSON as the Flask
+views, without their caching headers; the quiz index and the empirical
+difficulties are read from PostgreSQL, so they can lag the Flask
+process's own by up to `AsyncQuestionIndex.ttl` seconds and by the
+answer counts not yet flushed.
+"""
+import asyncio
+import json
+import math
+import re
+import time
+from urllib.parse import parse_qs
+
+from .admission import AsyncConcurrencyLimiter, MemoryRateLimitStore
+from .answer_stats import answer_stats, SERVED
+from .question_index import QuestionIndex, category_key, target_difficulty
+from .search import escape_like
+
+QUESTIONS_PER_PAGE = 10
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+WITH_ANSWER_COUNTS = \
+    'correct, wrong FROM questions LEFT JOIN question_stats ON question_id = id'
+
+
+class HTTPError(Exception):
+
+    messages = {
+        400: 'bad request',
+        404: 'resource not found',
+        405: 'method not allowed',
+        422: 'unprocessable',
+        429: 'too many requests',
+        503: 'service unavailable',
+    }
+
+    def __init__(self, status, retry_after=None):
+        self.status = status
+        self.retry_after = retry_after
+
+
+def dumps(payload):
+    """Serialise like Flask's jsonify: sorted keys, compact, newline."""
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':'))
+            + '\n').encode()
+
+
+def asyncpg_dsn(database_uri):
+    """Turn a SQLAlchemy URI into a DSN asyncpg understands."""
+    scheme, rest = database_uri.split('://', 1)
+    if not scheme.startswith('postgres'):
+        raise ValueError('the ASGI app requires a PostgreSQL database')
+    return 'postgresql://' + rest
+
+
+def question_row(row):
+    return {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty']
+    }
+
+
+def listed_question_row(row):
+    """question_row() plus the empirical difficulty, as /questions lists."""
+    question = question_row(row)
+    question['empirical_difficulty'] = answer_stats.difficulty_from(
+        row['difficulty'], row['correct'] or 0, row['wrong'] or 0)
+    return question
+
+
+class AsyncQuestionIndex(QuestionIndex):
+    """question_index.QuestionIndex loaded through asyncpg.
+
+    It cannot observe writes made through the Flask app, so it is rebuilt
+    every `ttl` seconds by refresh(), which handlers await before using
+    it; the effective difficulties come from question_stats in the same
+    query.
+    """
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl, difficulty_of=self._effective_difficulty)
+        self._answers = {}
+
+    def _ensure_loaded(self):
+        pass
+
+    def _effective_difficulty(self, question_id, declared):
+        correct, wrong = self._answers.get(question_id, (0, 0))
+        return answer_stats.effective_from(declared, correct, wrong)
+
+    async def refresh(self, pool):
+        if self.fresh():
+            return
+        rows = await pool.fetch(
+            f'SELECT id, category, difficulty, {WITH_ANSWER_COUNTS} '
+            'WHERE deleted_at IS NULL')
+        self._answers = {row['id']: (row['correct'] or 0, row['wrong'] or 0)
+                         for row in rows}
+        self._rebuild((row['id'], row['category'], row['difficulty'])
+                      for row in rows)
+        self._loaded_at = time.monotonic()
+
+
+class TriviaASGI:
+    """The async routes, each with the rule of its Flask view.
+
+    `admission` is the Flask app's AdmissionControl: its RATE_LIMITS
+    buckets are shared with the Flask routes, and its CONCURRENCY_LIMITS
+    are enforced here by AsyncConcurrencyLimiter, so the async routes
+    answer 429 and 503 like the Flask ones.
+    """
+
+    def __init__(self, config, fallback=None, admission=None):
+        self.config = config
+        self.fallback = fallback
+        self.admission = admission
+        self.limiters = {
+            rule: AsyncConcurrencyLimiter(limiter.limit, limiter.queue_size,
+                                          limiter.timeout)
+            for rule, limiter
+            in (admission.limiters.items() if admission else ())
+        }
+        self.pool = None
+        self.index = AsyncQuestionIndex()
+        self._categories = None
+        self._categories_loaded_at = None
+        self.routes = [
+            ('GET', '/categories', re.compile(r'^/categories$'),
+             self.get_categories),
+            ('GET', '/questions', re.compile(r'^/questions$'),
+             self.get_questions),
+            ('GET', '/categories/<int:category_id>/questions',
+             re.compile(r'^/categories/(\d+)/questions$'),
+             self.get_questions_by_category),
+            ('POST', '/search', re.compile(r'^/search$'),
+             self.search_by_term),
+            ('POST', '/quiz', re.compile(r'^/quiz$'), self.get_random_quiz),
+        ]
+
+    async def startup(self):
+        import asyncpg
+        options = {}
+        if self.config.get('DATABASE_CONNECT_TIMEOUT') is not None:
+            options['timeout'] = self.config['DATABASE_CONNECT_TIMEOUT']
+        if self.config.get('DATABASE_STATEMENT_TIMEOUT_MS') is not None:
+            options['command_timeout'] = \
+                self.config['DATABASE_STATEMENT_TIMEOUT_MS'] / 1000
+        self.pool = await asyncpg.create_pool(
+            asyncpg_dsn(self.config['SQLALCHEMY_DATABASE_URI']),
+            min_size=1,
+            max_size=self.config.get('DATABASE_POOL_SIZE') or 10,
+            **options
+        )
+
+    async def shutdown(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        for method, rule, pattern, handler in self.routes:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            if scope['method'] != method:
+                if self.fallback is not None:
+                    break
+                await self.respond(send, 405, self.error(405))
+                return
+            limiter = None
+            try:
+                limiter = await self.admit(scope, rule)
+                body = await handler(scope, await self.read_json(receive),
+                                     *match.groups())
+                await self.respond(send, 200, body)
+            except HTTPError as e:
+                headers = []
+                if e.retry_after is not None:
+                    headers.append(
+                        (b'retry-after', str(e.retry_after).encode()))
+                await self.respond(send, e.status, self.error(e.status),
+                                   headers)
+            finally:
+                if limiter is not None:
+                    limiter.release()
+            return
+
+        if self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        else:
+            await self.respond(send, 404, self.error(404))
+
+    async def admit(self, scope, rule):
+        """Apply the rate limit and concurrency cap of `rule`.
+
+        Returns the limiter to release once the response is sent, if the
+        route has one. A store other than the in-memory one does network
+        I/O, so it is called from the default executor.
+        """
+        if self.admission is None:
+            return None
+        client = (scope.get('client') or ('',))[0]
+        if rule in self.admission.rate_limits:
+            if isinstance(self.admission.store, MemoryRateLimitStore):
+                retry_after = self.admission.rate_limited(client, rule)
+            else:
+                retry_after = await asyncio.get_running_loop() \
+                    .run_in_executor(None, self.admission.rate_limited,
+                                     client, rule)
+            if retry_after:
+                raise HTTPError(429, retry_after)
+        limiter = self.limiters.get(rule)
+        if limiter is not None and not await limiter.acquire():
+            raise HTTPError(503, max(1, math.ceil(limiter.timeout)))
+        return limiter
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_json(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body = b''.join(chunks)
+        if not body:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise HTTPError(400)
+
+    def error(self, status):
+        return {
+            'success': False,
+            'error': status,
+            'message': HTTPError.messages[status]
+        }
+
+    async def respond(self, send, status, payload, headers=()):
+        body = dumps(payload)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'access-control-allow-headers',
+                 b'Content-Type, Authorization'),
+                (b'access-control-allow-methods',
+                 b'GET, POST, DELETE, OPTIONS'),
+            ] + list(headers)
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def categories(self):
+        """{id: type} of every category, reloaded with the quiz index."""
+        if self._categories_loaded_at is None \
+                or time.monotonic() - self._categories_loaded_at \
+                >= self.index.ttl:
+            rows = await self.pool.fetch(
+                'SELECT id, type FROM categories ORDER BY id')
+            self._categories = {row['id']: row['type'] for row in rows}
+            self._categories_loaded_at = time.monotonic()
+        return self._categories
+
+    def query_arg(self, scope, name):
+        values = parse_qs(scope['query_string'].decode()).get(name)
+        if not values:
+            return None
+        try:
+            return int(values[0])
+        except ValueError:
+            return None
+
+    async def get_categories(self, scope, body):
+        categories = await self.categories()
+        if not categories:
+            raise HTTPError(404)
+        return {'success': True, 'categories': list(categories)}
+
+    async def get_questions(self, scope, body):
+        page = self.query_arg(scope, 'page') or 1
+        after_id = self.query_arg(scope, 'after_id')
+
+        total_questions = await self.pool.fetchval(
+            'SELECT count(id) FROM questions WHERE deleted_at IS NULL')
+        if not total_questions:
+            raise HTTPError(404)
+
+        if after_id is not None:
+            rows = await self.pool.fetch(
+                f'SELECT {QUESTION_COLUMNS}, {WITH_ANSWER_COUNTS} '
+                'WHERE id > $1 AND deleted_at IS NULL ORDER BY id LIMIT $2',
+                after_id, QUESTIONS_PER_PAGE)
+            if not rows:
+                raise HTTPError(404)
+        else:
+            max_page = -(-total_questions // QUESTIONS_PER_PAGE)
+            if page < 1 or page > max_page:
+                raise HTTPError(404)
+            rows = await self.pool.fetch(
+                f'SELECT {QUESTION_COLUMNS}, {WITH_ANSWER_COUNTS} '
+                'WHERE deleted_at IS NULL ORDER BY id LIMIT $1 OFFSET $2',
+                QUESTIONS_PER_PAGE, (page - 1) * QUESTIONS_PER_PAGE)
+
+        categories = await self.categories()
+        response = {
+            'success': True,
+            'questions': [listed_question_row(row) for row in rows],
+            'total_questions': total_questions,
+            'categories': list(categories),
+            'current_category': categories.get(rows[0]['category'])
+        }
+        if after_id is not None:
+            response['next_after_id'] = rows[-1]['id'] \
+                if len(rows) == QUESTIONS_PER_PAGE else None
+        return response
+
+    async def get_questions_by_category(self, scope, body, category_id):
+        category_id = int(category_id) + 1
+        rows = await self.pool.fetch(
+            f'SELECT {QUESTION_COLUMNS} FROM questions WHERE category = $1 '
+            'AND deleted_at IS NULL ORDER BY id', category_id)
+        current_category = (await self.categories()).get(category_id)
+        if not rows or current_category is None:
+            raise HTTPError(422)
+        return {
+            'success': True,
+            'questions': [question_row(row) for row in rows],
+            'total_questions': len(rows),
+            'current_category': current_category
+        }
+
+    async def search_by_term(self, scope, body):
+        # like the Flask view, a malformed body is answered with 404
+        if not body or not isinstance(body, dict):
+            raise HTTPError(404)
+        search_term = body.get('searchTerm')
+        page = body.get('page', 1)
+        if not search_term or not isinstance(search_term, str) \
+                or not isinstance(page, int) or page < 1:
+            raise HTTPError(404)
+
+        pattern = f'%{escape_like(search_term)}%'
+        total_questions = await self.pool.fetchval(
+            "SELECT count(id) FROM questions "
+            "WHERE question ILIKE $1 ESCAPE '\\' AND deleted_at IS NULL",
+            pattern)
+        rows = await self.pool.fetch(
+            f"SELECT {QUESTION_COLUMNS} FROM questions "
+            "WHERE question ILIKE $1 ESCAPE '\\' AND deleted_at IS NULL "
+            "ORDER BY word_similarity($2, question) DESC, id "
+            "LIMIT $3 OFFSET $4",
+            pattern, search_term, QUESTIONS_PER_PAGE,
+            (page - 1) * QUESTIONS_PER_PAGE)
+        if not rows:
+            raise HTTPError(404)
+
+        return {
+            'success': True,
+            'questions': [question_row(row) for row in rows],
+            'total_questions': total_questions,
+            'page': page,
+            'current_category':
+                (await self.categories()).get(rows[0]['category'])
+        }
+
+    async def get_random_quiz(self, scope, body):
+        if not body or not isinstance(body, dict):
+            raise HTTPError(422)
+        await self.index.refresh(self.pool)
+        try:
+            category_id = body['quiz_category']['id'] or None
+            previous_questions = body['previous_questions'] or ()
+            exclude = set(previous_questions)
+            target = target_difficulty(
+                self.index.difficulty_histogram(category_id),
+                target=body.get('target_difficulty'),
+                curve=body.get('difficulty_curve'),
+                streak=body.get('streak'),
+                served=len(previous_questions)
+                )
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(422)
+
+        while True:
+            question_id = self.index.sample(category_id, exclude, target)
+            if question_id is None:
+                raise HTTPError(422)
+            row = await self.pool.fetchrow(
+                f'SELECT {QUESTION_COLUMNS} FROM questions WHERE id = $1 '
+                'AND deleted_at IS NULL',
+                question_id)
+            if row is not None:
+                break
+            self.index.discard(question_id)
+            exclude.add(question_id)
+
+        answer_stats.record(question_id, SERVED)
+        response = {'success': True, 'question': question_row(row)}
+        if target is not None:
+            response['target_difficulty'] = target
+        return response
+
+
+def create_asgi_app(test_config=None):
+    """Build the ASGI app, falling back to Flask for unported routes."""
+    from . import create_app
+
+    flask_app = create_app(test_config)
+    try:
+        from asgiref.wsgi import WsgiToAsgi
+    except ImportError:
+        fallback = None
+    else:
+        fallback = WsgiToAsgi(flask_app)
+
+    try:
+        import asyncpg  # noqa: F401
+    except ImportError:
+        if fallback is None:
+            raise RuntimeError(
+                'the ASGI app needs asyncpg (async routes) '
+                'or asgiref (Flask fallback)'
+            )
+        return fallback
+
+    return TriviaASGI(dict(flask_app.config), fallback,
+                      flask_app.extensions.get('admission'))
@@ -0,0 +1,352 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import and_, func, select
+
+from models import db, Question, category_registry, notify_question_change
+from .serialization import QUESTION_FIELDS
+
+MAX_DIFFICULTY = 5
+IMPORT_BATCH_SIZE = 1000
+INSERT_BATCH_SIZE = 1000
+# SQLite allows 999 bind parameters per statement by default, four per row
+SQLITE_INSERT_BATCH_SIZE = 999 // 4
+EXPORT_BATCH_SIZE = 1000
+PURGE_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+EXPORT_FIELDS = ('id',) + FIELDS
+
+
+class RowError(ValueError):
+    pass
+
+
+def is_utf8(text):
+    """False if `text` holds bytes that 'surrogateescape' could not decode."""
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def read_ndjson(stream):
+    """Yield (line number, row dict) from an NDJSON byte stream.
+
+    A line that is not valid UTF-8 is yielded as a RowError, which
+    validate_row() reports for that line.
+    """
+    lines = io.TextIOWrapper(stream, 'utf-8', errors='surrogateescape')
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        if not is_utf8(line):
+            yield number, RowError('line is not valid UTF-8')
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row
+
+
+def read_csv(stream):
+    """Yield (line number, row dict) from a CSV byte stream with a header.
+
+    Rows that are not valid UTF-8 are yielded as RowErrors, as by
+    read_ndjson().
+    """
+    reader = csv.DictReader(io.TextIOWrapper(
+        stream, 'utf-8', errors='surrogateescape', newline=''
+    ))
+    for row in reader:
+        if not all(is_utf8(value) for value in row.values()
+                   if isinstance(value, str)):
+            yield reader.line_num, RowError('line is not valid UTF-8')
+        else:
+            yield reader.line_num, row
+
+
+def integer_value(value):
+    """`value` as an int, from JSON numbers or CSV text, or ValueError.
+
+    Booleans and fractional numbers are rejected rather than coerced.
+    """
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    if isinstance(value, (int, str)):
+        return int(value)
+    raise ValueError(value)
+
+
+def validate_row(row):
+    """Return the insertable column values for `row` or raise RowError."""
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError('row is not an object')
+    try:
+        question = row['question']
+        answer = row['answer']
+        category = integer_value(row['category'])
+        difficulty = integer_value(row['difficulty'])
+    except KeyError as e:
+        raise RowError(f'missing field {e.args[0]}')
+    except ValueError:
+        raise RowError('category and difficulty must be integers')
+
+    if not (isinstance(question, str) and isinstance(answer, str)):
+        raise RowError('question and answer must be strings')
+    question = question.strip()
+    answer = answer.strip()
+    if not (question and answer):
+        raise RowError('question and answer are required')
+    if category not in category_registry:
+        raise RowError('category does not exist')
+    if difficulty < 1:
+        raise RowError('minimum difficulty is 1')
+    if difficulty > MAX_DIFFICULTY:
+        raise RowError(f'maximum difficulty is {MAX_DIFFICULTY}')
+
+    return {
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def insert_rows(rows):
+    """Insert validated rows in the current transaction.
+
+    PostgreSQL receives them through COPY; other databases get a single
+    executemany INSERT.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in FIELDS])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            'COPY questions (question, answer, category, difficulty) '
+            'FROM STDIN WITH (FORMAT csv)',
+            buffer
+        )
+    else:
+        connection.execute(Question.__table__.insert(), rows)
+
+
+def create_questions(items):
+    """Validate a list of questions and insert the valid ones at once.
+
+    All valid items are inserted in one transaction by one multi-row
+    INSERT per batch: INSERT_BATCH_SIZE rows with RETURNING id on
+    PostgreSQL, which keeps each statement well under the server's limit
+    of 65535 bind parameters, and SQLITE_INSERT_BATCH_SIZE rows (999
+    bind parameters) elsewhere, where SQLite numbers the rows of one
+    statement consecutively up to its lastrowid. Returns one result per
+    item, in order: either the created question or the validation error.
+    """
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate_row(item))
+            results.append(None)
+        except RowError as e:
+            results.append({'index': index, 'success': False,
+                            'message': str(e)})
+    if not rows:
+        return results
+
+    table = Question.__table__
+    postgresql = db.session.connection().dialect.name == 'postgresql'
+    batch_size = INSERT_BATCH_SIZE if postgresql else SQLITE_INSERT_BATCH_SIZE
+    ids = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        statement = table.insert().values(batch)
+        if postgresql:
+            ids.extend(question_id for question_id, in db.session.execute(
+                statement.returning(table.c.id)))
+        else:
+            last_id = db.session.execute(statement).lastrowid
+            ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+    db.session.commit()
+    created = [dict(row, id=question_id)
+               for row, question_id in zip(rows, ids)]
+
+    notify_question_change('insert', created)
+    created = iter(created)
+    for index, result in enumerate(results):
+        if result is None:
+            results[index] = {'index': index, 'success': True,
+                              'question': next(created)}
+    return results
+
+
+def import_questions(records, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """Validate and insert (line number, row) records in chunks.
+
+    Each chunk is validated as a whole and committed in its own
+    transaction, so memory use is bounded by `batch_size` regardless of
+    how large the upload is. `progress`, if given, is called with the
+    number of records processed after each chunk. Returns (imported,
+    rejected, errors).
+    """
+    imported = rejected = 0
+    errors = []
+    records = iter(records)
+    try:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            rows = []
+            for number, row in batch:
+                try:
+                    rows.append(validate_row(row))
+                except RowError as e:
+                    rejected += 1
+                    if len(errors) < MAX_REPORTED_ERRORS:
+                        errors.append({'line': number, 'error': str(e)})
+            if rows:
+                insert_rows(rows)
+                db.session.commit()
+                imported += len(rows)
+            if progress is not None:
+                progress(imported + rejected)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if imported:
+            notify_question_change('reset')
+    return imported, rejected, errors
+
+
+def delete_questions(ids=None, category=None, difficulty=None, soft=False):
+    """Delete every question matching all of the given criteria at once.
+
+    The rows are deleted (or, with `soft`, stamped with deleted_at) by a
+    single statement and committed together, instead of a lookup, delete
+    and commit per question. PostgreSQL returns the affected rows from
+    the statement itself; elsewhere they are selected first in the same
+    transaction. Returns the deleted questions as format() dicts.
+    """
+    table = Question.__table__
+    conditions = [table.c.deleted_at.is_(None)]
+    if ids is not None:
+        conditions.append(table.c.id.in_(ids))
+    if category is not None:
+        conditions.append(table.c.category == category)
+    if difficulty is not None:
+        conditions.append(table.c.difficulty == difficulty)
+    condition = and_(*conditions)
+
+    if soft:
+        statement = table.update().where(condition) \
+            .values(deleted_at=datetime.utcnow())
+    else:
+        statement = table.delete().where(condition)
+    columns = [table.c[field] for field in QUESTION_FIELDS]
+    try:
+        if db.session.connection().dialect.name == 'postgresql':
+            rows = db.session.execute(statement.returning(*columns)).fetchall()
+        else:
+            rows = db.session.execute(select(columns).where(condition)) \
+                .fetchall()
+            if rows:
+                db.session.execute(statement)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    deleted = [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+    if deleted:
+        notify_question_change('delete', deleted)
+    return deleted
+
+
+def purge_deleted_questions(older_than=0, batch_size=PURGE_BATCH_SIZE,
+                            progress=None):
+    """Remove soft-deleted questions for good, `batch_size` at a time.
+
+    Only tombstones at least `older_than` seconds old are purged. Every
+    batch is deleted and committed on its own, so locks are held briefly
+    and the write-ahead log grows in small steps. `progress`, if given,
+    is called with (purged, total) after each batch. Returns the number
+    of questions purged.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    tombstone = Question.deleted_at <= cutoff
+    total = db.session.query(func.count(Question.id)) \
+        .filter(tombstone).scalar()
+    purged = 0
+    while True:
+        ids = [
+            question_id for question_id, in db.session.query(Question.id)
+            .filter(tombstone).order_by(Question.deleted_at)
+            .limit(batch_size)
+        ]
+        if not ids:
+            break
+        db.session.execute(
+            Question.__table__.delete().where(Question.__table__.c.id.in_(ids))
+        )
+        db.session.commit()
+        purged += len(ids)
+        if progress is not None:
+            progress(purged, max(total, purged))
+    return purged
+
+
+def export_questions(output_format='ndjson', batch_size=EXPORT_BATCH_SIZE):
+    """Yield the questions table as NDJSON lines or CSV rows.
+
+    Rows are read through a server-side cursor (`stream_results`) in
+    batches of `batch_size`, so the full table is never held in memory.
+    """
+    query = db.session.query(
+        Question.id,
+        Question.question,
+        Question.answer,
+        Question.category,
+        Question.difficulty
+        ).filter(Question.not_deleted()).order_by(Question.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
+    if output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for row in query:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        lines = []
+        for row in query:
+            lines.append(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+            if len(lines) >= batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
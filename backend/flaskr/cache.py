@@ -0,0 +1,288 @@
+import json
+import logging
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import request, Response
+
+from models import on_question_change
+from .streaming import stream_mode
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """Key/value store for ResponseCache.
+
+    Values are bytes. set() and add() take a ttl in seconds (None keeps
+    the value until it is evicted); add() only stores the value if the key
+    is absent and reports whether it did, which is what the single-flight
+    lock in ResponseCache is built on.
+    """
+
+    def get_many(self, keys):
+        raise NotImplementedError
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def incr(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LocalCacheBackend(CacheBackend):
+    """In-process LRU; every worker process has its own."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._live(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            self._store(key, str(value).encode(), None)
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by every node through a Redis-protocol server.
+
+    `client` is a redis-py client, or anything with the same get/mget/
+    set/incr/delete methods (such as a stand-in in tests); from_url()
+    builds one from CACHE_REDIS_URL. Keys are namespaced with `prefix`.
+    """
+
+    def __init__(self, client, prefix='trivia:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix='trivia:'):
+        import redis
+        return cls(redis.Redis.from_url(url, socket_timeout=1), prefix)
+
+    @staticmethod
+    def _px(ttl):
+        return int(ttl * 1000) if ttl is not None else None
+
+    def get_many(self, keys):
+        return self.client.mget([self.prefix + key for key in keys])
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, px=self._px(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, value, nx=True,
+                                    px=self._px(ttl)))
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+cache_backends = {
+    'local': LocalCacheBackend,
+    'redis': RedisCacheBackend,
+}
+
+
+def get_cache_backend(config):
+    """Build the cache backend named by CACHE_BACKEND in the app config.
+
+    CACHE_BACKEND may also be a CacheBackend instance. By default Redis is
+    used when CACHE_REDIS_URL is set and the local LRU otherwise.
+    """
+    backend = config.get('CACHE_BACKEND')
+    if isinstance(backend, CacheBackend):
+        return backend
+    if backend is None:
+        backend = 'redis' if config.get('CACHE_REDIS_URL') else 'local'
+    if backend == 'redis':
+        return RedisCacheBackend.from_url(config['CACHE_REDIS_URL'])
+    return cache_backends[backend]()
+
+
+class ResponseCache:
+    """Serialised JSON bodies of the read-only routes, kept in a CacheBackend.
+
+    Entries are keyed by path and query string (plus the JSON body for
+    POST /search) and tagged with a data version stored in the backend
+    itself. Question.insert()/delete() increment that version, so with a
+    shared backend every node sees the invalidation at once. The ETag and
+    Last-Modified headers are derived from the same version, which lets a
+    matching If-None-Match/If-Modified-Since on a GET be answered with 304
+    before the view (or the database) is touched.
+
+    ETags also roll over every `ttl` seconds so writes that skip the
+    listeners (other tools, or other workers on a local backend) are seen
+    within that window; Last-Modified is never older than the start of
+    the window, so If-Modified-Since rolls over with it. On a miss only
+    one request per key recomputes the body while the others wait up to
+    `lock_timeout` seconds for it. Streamed responses (see
+    flaskr.streaming) bypass the cache, and so does every request while
+    the backend is unreachable.
+    """
+
+    poll_interval = 0.02
+
+    def __init__(self, backend=None, ttl=30, lock_timeout=5):
+        self.backend = backend if backend is not None else LocalCacheBackend()
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._started_at = time.time()
+        _caches.add(self)
+
+    def invalidate(self):
+        self.backend.incr('version')
+        self.backend.set('changed_at', repr(time.time()).encode())
+
+    def _key(self):
+        key = request.path + '?' + '&'.join(
+            f'{name}={value}'
+            for name, value in sorted(request.args.items(multi=True))
+        )
+        if request.method == 'POST':
+            key += '#' + json.dumps(request.get_json(silent=True),
+                                    sort_keys=True, separators=(',', ':'))
+        return key
+
+    def _version(self):
+        version, changed_at = self.backend.get_many(['version', 'changed_at'])
+        changed_at = float(changed_at) if changed_at else self._started_at
+        epoch = int(time.time() // self.ttl)
+        return f'{int(version or 0)}.{epoch}', max(changed_at,
+                                                   epoch * self.ttl)
+
+    def _not_modified(self, etag, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if request.if_modified_since:
+            # werkzeug parses HTTP dates without a timezone; they are UTC
+            since = request.if_modified_since
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return since >= last_modified
+        return False
+
+    def _compute(self, body_key, view, args, kwargs):
+        lock_key = 'lock:' + body_key
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.backend.add(lock_key, b'1', self.lock_timeout):
+            if time.monotonic() >= deadline:
+                return view(*args, **kwargs)
+            time.sleep(self.poll_interval)
+            body = self.backend.get(body_key)
+            if body is not None:
+                return Response(body, mimetype='application/json')
+        try:
+            response = view(*args, **kwargs)
+            if response.status_code == 200:
+                self.backend.set(body_key, response.get_data(), 2 * self.ttl)
+            return response
+        finally:
+            self.backend.delete(lock_key)
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if stream_mode() is not None:
+                return view(*args, **kwargs)
+            try:
+                key = self._key()
+                version, changed_at = self._version()
+                body_key = f'body:{version}:{key}'
+                body = self.backend.get(body_key)
+            except Exception as e:
+                logger.warning('response cache unavailable: %s', e)
+                return view(*args, **kwargs)
+
+            etag = f'{version}-{zlib.crc32(key.encode()):08x}'
+            last_modified = datetime.fromtimestamp(
+                int(changed_at), timezone.utc
+            )
+
+            if request.method == 'GET' \
+                    and self._not_modified(etag, last_modified):
+                response = Response(status=304)
+            elif body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response = self._compute(body_key, view, args, kwargs)
+                if response.status_code != 200:
+                    return response
+
+            if request.method == 'GET':
+                response.set_etag(etag)
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+
+
+_caches = weakref.WeakSet()
+
+
+@on_question_change
+def _invalidate_caches(action, questions):
+    for cache in list(_caches):
+        try:
+            cache.invalidate()
+        except Exception as e:
+            logger.warning('could not invalidate response cache: %s', e)
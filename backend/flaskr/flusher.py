@@ -0,0 +1,79 @@
+import atexit
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessThreads:
+    """Starts a set of daemon threads once per process.
+
+    start() is cheap enough to call on every request: after the first
+    call in a process it is a pid comparison, and a forked child (whose
+    threads did not survive the fork) starts its own on its first call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self, target, name, count=1):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        for number in range(count):
+            threading.Thread(
+                target=target,
+                name=name if count == 1 else f'{name}-{number}',
+                daemon=True
+            ).start()
+
+
+class PeriodicFlusher:
+    """Base for in-memory buffers written to the database in the background.
+
+    Subclasses implement flush(). A daemon thread calls it every
+    `flush_interval` seconds, or sooner after wake(), and it is called
+    once more at exit. The thread is started on first use (see
+    ensure_worker()), so every forked worker process runs its own.
+    """
+
+    name = 'flusher'
+    interval_setting = None
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.app = None
+        self._wake = threading.Event()
+        self._threads = ProcessThreads()
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.flush)
+        self.app = app
+        if self.interval_setting is not None:
+            self.flush_interval = app.config.get(
+                self.interval_setting, self.flush_interval
+            )
+
+    def wake(self):
+        self._wake.set()
+
+    def ensure_worker(self):
+        self._threads.start(self._run, self.name)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning('%s could not flush: %s', self.name, e)
+
+    def flush(self):
+        raise NotImplementedError
@@ -0,0 +1,431 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, category_registry, notify_question_change
+from .answer_stats import answer_stats
+from .flusher import ProcessThreads
+from .bulk import import_questions, purge_deleted_questions, read_csv, \
+    read_ndjson, PURGE_BATCH_SIZE
+from .leaderboard import leaderboard
+from .question_index import question_index
+from .search import get_search_backend
+from .snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+
+
+class JobError(Exception):
+    """Raised by a job that should fail without being retried."""
+
+
+class JobType:
+
+    def __init__(self, run, max_attempts=None, public=True):
+        self.run = run
+        self.max_attempts = max_attempts
+        self.public = public
+
+
+job_types = {}
+
+
+def job(name, max_attempts=None, public=True):
+    """Register `run(params, progress)` as the job type `name`.
+
+    `progress(done, total=None)` records how far the job has got; the
+    return value must be JSON serialisable and becomes the job's result.
+    Jobs that are not `public` cannot be submitted through POST /jobs.
+    """
+    def register(run):
+        job_types[name] = JobType(run, max_attempts, public)
+        return run
+    return register
+
+
+class JobQueue:
+    """Durable job queue kept in a local SQLite file.
+
+    Jobs survive restarts and the file can be shared by every worker
+    process on a host: claim() takes a job inside a write transaction,
+    so each job is run by one process at a time. A claimed job holds a
+    lease that progress() extends; a job whose lease runs out (its
+    process died) is claimed again.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' type TEXT NOT NULL,'
+        ' params TEXT NOT NULL,'
+        ' status TEXT NOT NULL,'
+        ' attempts INTEGER NOT NULL DEFAULT 0,'
+        ' max_attempts INTEGER NOT NULL,'
+        ' done INTEGER,'
+        ' total INTEGER,'
+        ' result TEXT,'
+        ' error TEXT,'
+        ' run_after REAL NOT NULL,'
+        ' lease_expires REAL,'
+        ' created_at REAL NOT NULL,'
+        ' updated_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after '
+        'ON jobs (status, run_after)',
+    )
+
+    # finished jobs are deleted after this many seconds
+    retention = 7 * 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # one connection per thread, and none inherited across a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def put(self, job_type, params, max_attempts):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?',
+                (SUCCEEDED, FAILED, now - self.retention)
+            )
+            cursor = connection.execute(
+                'INSERT INTO jobs (type, params, status, max_attempts,'
+                ' run_after, created_at, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_type, json.dumps(params), QUEUED, max_attempts,
+                 now, now, now)
+            )
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        return self._connection().execute(
+            'SELECT * FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+
+    def claim(self, lease):
+        """Mark the next due job as running and return it, or None."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = connection.execute(
+                    'SELECT * FROM jobs'
+                    ' WHERE (status = ? AND run_after <= ?)'
+                    ' OR (status = ? AND lease_expires < ?)'
+                    ' ORDER BY run_after, id LIMIT 1',
+                    (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is None or row['status'] == QUEUED \
+                        or row['attempts'] < row['max_attempts']:
+                    break
+                connection.execute(
+                    'UPDATE jobs SET status = ?, error = ?, updated_at = ?'
+                    ' WHERE id = ?',
+                    (FAILED, 'worker stopped while running the job', now,
+                     row['id'])
+                )
+            if row is not None:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1,'
+                    ' lease_expires = ?, updated_at = ? WHERE id = ?',
+                    (RUNNING, now + lease, now, row['id'])
+                )
+                row = self.get(row['id'])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return row
+
+    def _update(self, row, assignments, values):
+        # a job that was claimed again since `row` is no longer ours
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'UPDATE jobs SET {}, updated_at = ?'
+                ' WHERE id = ? AND attempts = ?'.format(assignments),
+                tuple(values) + (time.time(), row['id'], row['attempts'])
+            )
+
+    def progress(self, row, done, total, lease):
+        self._update(row, 'done = ?, total = ?, lease_expires = ?',
+                     (done, total, time.time() + lease))
+
+    def renew(self, row, lease):
+        self._update(row, 'lease_expires = ?', (time.time() + lease,))
+
+    def succeed(self, row, result):
+        self._update(row, 'status = ?, result = ?, error = NULL,'
+                     ' lease_expires = NULL',
+                     (SUCCEEDED, json.dumps(result)))
+
+    def fail(self, row, error, retry_after=None):
+        """Fail the job, or queue it again in `retry_after` seconds."""
+        if retry_after is None:
+            self._update(row, 'status = ?, error = ?, lease_expires = NULL',
+                         (FAILED, error))
+        else:
+            self._update(row, 'status = ?, error = ?, run_after = ?,'
+                         ' lease_expires = NULL',
+                         (QUEUED, error, time.time() + retry_after))
+
+
+def format_job(row):
+    def timestamp(value):
+        return datetime.utcfromtimestamp(value).isoformat()
+
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'max_attempts': row['max_attempts'],
+        'progress': {'done': row['done'], 'total': row['total']},
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+        'created_at': timestamp(row['created_at']),
+        'updated_at': timestamp(row['updated_at'])
+    }
+
+
+class JobRunner:
+    """Runs queued jobs on a pool of background threads.
+
+    submit() only writes the job to the JobQueue and returns; worker
+    threads claim and run jobs inside an app context. A job that raises
+    is retried up to `max_attempts` times in all, with the delay doubling
+    from `retry_delay` seconds, unless it raised JobError. While a job
+    runs its lease is renewed every `lease / 3` seconds, so only a job
+    whose process died is claimed again.
+
+    Web processes only queue jobs by default: run `python worker.py` to
+    process them (see work()). With `workers` above 0 every app process,
+    including each forked web worker, also starts that many threads on
+    its first request.
+    """
+
+    poll_interval = 1.0
+    max_poll_interval = 60.0
+    lease = 300
+
+    def __init__(self, workers=0, max_attempts=3, retry_delay=5.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.app = None
+        self.queue = None
+        self.upload_dir = None
+        self._wake = threading.Event()
+        self._threads = ProcessThreads()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('JOBS_WORKERS', self.workers)
+        self.max_attempts = app.config.get(
+            'JOBS_MAX_ATTEMPTS', self.max_attempts
+        )
+        self.retry_delay = app.config.get(
+            'JOBS_RETRY_DELAY', self.retry_delay
+        )
+        path = app.config.get('JOBS_DATABASE') \
+            or os.path.join(app.instance_path, 'jobs.db')
+        self.upload_dir = os.path.join(os.path.dirname(path), 'uploads')
+        if self.queue is None or self.queue.path != path:
+            self.queue = JobQueue(path)
+        if self.workers:
+            app.before_request(self.ensure_workers)
+
+    def submit(self, job_type, params=None):
+        """Queue a job and return it as format_job() shows it."""
+        if job_type not in job_types:
+            raise KeyError(job_type)
+        max_attempts = job_types[job_type].max_attempts or self.max_attempts
+        job_id = self.queue.put(job_type, params or {}, max_attempts)
+        self.ensure_workers()
+        self._wake.set()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self.queue.get(job_id)
+        return format_job(row) if row is not None else None
+
+    def spool(self, stream, chunk_size=65536):
+        """Save an upload for a job to read later; returns its name."""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        descriptor, path = tempfile.mkstemp(dir=self.upload_dir)
+        with os.fdopen(descriptor, 'wb') as upload:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                upload.write(chunk)
+        return os.path.basename(path)
+
+    def upload_path(self, name):
+        return os.path.join(self.upload_dir, os.path.basename(name))
+
+    def ensure_workers(self):
+        if self.workers:
+            self._threads.start(self._run, 'job-worker', self.workers)
+
+    def work(self, workers=1):
+        """Run jobs in the calling thread and `workers - 1` more, forever."""
+        if workers > 1:
+            self.workers = workers - 1
+            self.ensure_workers()
+        self._run()
+
+    def _run(self):
+        delay = self.poll_interval
+        while True:
+            try:
+                row = self.queue.claim(self.lease)
+            except Exception as e:
+                logger.warning('could not claim a job: %s', e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+                continue
+            delay = self.poll_interval
+            if row is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self.run(row)
+
+    def _renew_lease(self, row, done):
+        while not done.wait(self.lease / 3):
+            try:
+                self.queue.renew(row, self.lease)
+            except Exception as e:
+                logger.warning('could not renew the lease of job %s: %s',
+                               row['id'], e)
+
+    def run(self, row):
+        """Run a claimed job and record its outcome."""
+        def progress(done, total=None):
+            self.queue.progress(row, done, total, self.lease)
+
+        done = threading.Event()
+        threading.Thread(
+            target=self._renew_lease, args=(row, done),
+            name=f"job-{row['id']}-lease", daemon=True
+        ).start()
+        job_type = job_types.get(row['type'])
+        try:
+            if job_type is None:
+                raise JobError(f"unknown job type {row['type']}")
+            with self.app.app_context():
+                result = job_type.run(json.loads(row['params']), progress)
+        except JobError as e:
+            self.queue.fail(row, str(e))
+        except Exception as e:
+            logger.exception('job %s (%s) failed', row['id'], row['type'])
+            if row['attempts'] < row['max_attempts']:
+                self.queue.fail(
+                    row, str(e),
+                    retry_after=self.retry_delay * 2 ** (row['attempts'] - 1)
+                )
+            else:
+                self.queue.fail(row, str(e))
+        else:
+            self.queue.succeed(row, result)
+        finally:
+            done.set()
+
+
+jobs = JobRunner()
+
+
+@job('reindex_search')
+def reindex_search(params, progress):
+    """Rebuild the search index (REINDEX on PostgreSQL)."""
+    get_search_backend().rebuild()
+    return {}
+
+
+@job('recompute_aggregates')
+def recompute_aggregates(params, progress):
+    """Rebuild this process's in-memory aggregates from the database.
+
+    Only the process running the job is refreshed: the other workers'
+    copies are rebuilt when they expire (ten minutes at most). The
+    response caches, including a shared one, are invalidated everywhere
+    through the question change listeners.
+    """
+    notify_question_change('reset')
+    category_registry.invalidate()
+    leaderboard.invalidate()
+    answer_stats.invalidate()
+    counts = question_index.category_counts()
+    return {
+        'categories': category_registry.count(),
+        'questions': sum(counts.values())
+    }
+
+
+@job('purge_deleted')
+def purge_deleted(params, progress):
+    """Remove soft-deleted questions in batches (see SOFT_DELETE)."""
+    try:
+        older_than = float(params.get('older_than', 0))
+        batch_size = int(params.get('batch_size', PURGE_BATCH_SIZE))
+    except (TypeError, ValueError):
+        raise JobError('older_than and batch_size must be numbers')
+    if older_than < 0 or batch_size < 1:
+        raise JobError('older_than and batch_size must be positive')
+    return {
+        'purged': purge_deleted_questions(older_than, batch_size, progress)
+    }
+
+
+@job('export_snapshot')
+def export_snapshot(params, progress):
+    """Write a snapshot for read-only nodes to SNAPSHOT_EXPORT_PATH."""
+    path = current_app.config.get('SNAPSHOT_EXPORT_PATH') \
+        or os.path.join(current_app.instance_path, 'snapshot.bin')
+    version, count = write_snapshot(db.session.connection(), path)
+    return {'version': version, 'questions': count}
+
+
+@job('import', max_attempts=1, public=False)
+def import_upload(params, progress):
+    """Import an upload saved by JobRunner.spool(); see POST /questions/import."""
+    path = jobs.upload_path(params['upload'])
+    read = read_csv if params.get('format') == 'csv' else read_ndjson
+    try:
+        with open(path, 'rb') as stream:
+            imported, rejected, errors = import_questions(
+                read(stream), progress=progress
+            )
+    except FileNotFoundError:
+        raise JobError('upload is missing')
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return {'imported': imported, 'rejected': rejected, 'errors': errors}
@@ -0,0 +1,237 @@
+import bisect
+import itertools
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, QuizResult, category_registry
+from reloading import ReloadingCache
+from .flusher import PeriodicFlusher
+from .question_index import category_key
+
+logger = logging.getLogger(__name__)
+
+
+class ResultBuffer(PeriodicFlusher):
+    """Write-behind buffer for quiz results.
+
+    add() only appends to an in-memory queue. A background thread inserts
+    everything pending with a single executemany every `flush_interval`
+    seconds, or as soon as `batch_size` results are waiting, and the
+    queue is flushed once more at exit. While the database is unavailable
+    up to `max_pending` results are kept, dropping the oldest beyond that.
+    A batch that violates a constraint is written again row by row and
+    the rows the database rejects are logged and dropped, so one bad row
+    cannot hold up the results queued behind it.
+    """
+
+    name = 'result-buffer'
+    interval_setting = 'RESULTS_FLUSH_INTERVAL'
+
+    def __init__(self, flush_interval=1.0, batch_size=500,
+                 max_pending=100000):
+        super().__init__(flush_interval)
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        # held while a batch is written; see Leaderboard.reload
+        self.flush_lock = threading.Lock()
+        # number of flushes that have taken results off the queue
+        self.flushes = 0
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+    def pending_since(self, flushes):
+        """pending(), or None if a flush has started since `flushes`."""
+        with self._lock:
+            if self.flushes != flushes:
+                return None
+            return list(self._pending)
+
+    def add(self, row):
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self.batch_size
+        self.ensure_worker()
+        if full:
+            self.wake()
+
+    def flush(self):
+        """Insert every pending result; returns how many were written."""
+        with self.flush_lock:
+            with self._lock:
+                rows = list(self._pending)
+                self._pending.clear()
+                if rows:
+                    self.flushes += 1
+            if not rows or self.app is None:
+                return 0
+            with self.app.app_context():
+                try:
+                    db.session.execute(QuizResult.__table__.insert(), rows)
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    return self._insert_each(rows)
+                except Exception:
+                    self._requeue(rows)
+                    raise
+            return len(rows)
+
+    def _requeue(self, rows):
+        with self._lock:
+            rows.extend(self._pending)
+            self._pending = deque(rows, maxlen=self.max_pending)
+
+    def _insert_each(self, rows):
+        """Insert `rows` one at a time, dropping those that are rejected."""
+        written = 0
+        for position, row in enumerate(rows):
+            try:
+                db.session.execute(QuizResult.__table__.insert(), row)
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                logger.warning('dropping quiz result %r: %s', row, e.orig)
+                continue
+            except Exception:
+                db.session.rollback()
+                self._requeue(rows[position:])
+                raise
+            written += 1
+        return written
+
+
+class Leaderboard(ReloadingCache):
+    """Top `size` results overall and per category, kept in memory.
+
+    Each board is a list of entries sorted by score (highest first) and
+    then submission time (earliest first). Boards are loaded with one
+    LIMIT query per category, answered from the quiz_results score
+    indexes, and then kept up to date by add() as results come in, so
+    reading a leaderboard never touches the results table. They are
+    reloaded after `ttl` seconds to pick up results recorded by other
+    processes.
+    """
+
+    # optimistic reads of the boards before reload() holds off flushing
+    reload_attempts = 3
+
+    def __init__(self, buffer, size=100, ttl=60):
+        super().__init__(ttl)
+        self.buffer = buffer
+        self.size = size
+        self._boards = {}
+        self._sequence = itertools.count()
+
+    def _entry(self, row):
+        return (-row['score'], row['submitted_at'], next(self._sequence),
+                row['player'], row['total_questions'], row['category'])
+
+    def _top(self, category):
+        query = db.session.query(
+            QuizResult.score, QuizResult.submitted_at, QuizResult.player,
+            QuizResult.total_questions, QuizResult.category
+            )
+        if category is not None:
+            query = query.filter(QuizResult.category == category)
+        rows = query.order_by(
+            QuizResult.score.desc(), QuizResult.submitted_at
+            ).limit(self.size)
+        return [
+            self._entry(dict(zip(
+                ('score', 'submitted_at', 'player', 'total_questions',
+                 'category'), row
+            )))
+            for row in rows
+        ]
+
+    def _read_boards(self):
+        boards = {None: self._top(None)}
+        for category in category_registry.ids():
+            boards[category] = self._top(category)
+        return boards
+
+    def reload(self):
+        # Every result must be either in the table or still pending, never
+        # both or neither. That holds if no flush started while the boards
+        # were read, so retry a few times before holding flushes off.
+        for _ in range(self.reload_attempts):
+            # wait for a flush already writing, without blocking the next
+            with self.buffer.flush_lock:
+                flushes = self.buffer.flushes
+            boards = self._read_boards()
+            pending = self.buffer.pending_since(flushes)
+            if pending is not None:
+                break
+        else:
+            with self.buffer.flush_lock:
+                boards = self._read_boards()
+                pending = self.buffer.pending()
+        self._boards = boards
+        for row in pending:
+            self._insert(row)
+
+    def _insert(self, row):
+        entry = self._entry(row)
+        rank = None
+        for key in {None, row['category']}:
+            board = self._boards.setdefault(key, [])
+            if len(board) >= self.size and entry >= board[-1]:
+                continue
+            position = bisect.bisect(board, entry)
+            board.insert(position, entry)
+            del board[self.size:]
+            if key == row['category']:
+                rank = position + 1
+        return rank
+
+    def add(self, row):
+        """Queue a result for writing and put it on the boards.
+
+        Returns its rank on its category's board (the overall board for
+        games across all categories), or None if it is not in the top.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            self.buffer.add(row)
+            return self._insert(row)
+
+    def top(self, category=None, limit=10):
+        with self._lock:
+            self._ensure_loaded()
+            board = self._boards.get(category_key(category), [])[:limit]
+        return [
+            {
+                'rank': rank,
+                'player': player,
+                'score': -score,
+                'total_questions': total_questions,
+                'category': category,
+                'submitted_at': submitted_at.isoformat()
+            }
+            for rank, (score, submitted_at, _, player, total_questions,
+                       category) in enumerate(board, 1)
+        ]
+
+
+def record_result(player, category, score, total_questions):
+    """Record a finished quiz; returns the row and its rank (or None)."""
+    row = {
+        'player': player,
+        'category': category,
+        'score': score,
+        'total_questions': total_questions,
+        'submitted_at': datetime.utcnow()
+    }
+    return row, leaderboard.add(row)
+
+
+result_buffer = ResultBuffer()
+leaderboard = Leaderboard(result_buffer)
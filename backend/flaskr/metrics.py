@@ -0,0 +1,215 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, has_request_context, current_app, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def record_rows(fetched=0, returned=0):
+    """Add to the current request's row counts when metrics are enabled.
+
+    Views report the questions they put in a response as `returned`;
+    `fetched` is counted where rows are materialised (question_dicts()
+    and ORM loads).
+    """
+    if not has_request_context():
+        return
+    stats = g.get('request_stats')
+    if stats is not None:
+        stats.rows_fetched += fetched
+        stats.rows_returned += returned
+
+
+def format_labels(labels):
+    return ','.join(
+        f'{name}="{escape_label(value)}"' for name, value in labels
+    )
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram for one label set."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            bucket_labels = format_labels(labels + (('le', bound),))
+            yield f'{name}_bucket{{{bucket_labels}}} {cumulative}'
+        yield f'{name}_sum{{{format_labels(labels)}}} {self.sum}'
+        yield f'{name}_count{{{format_labels(labels)}}} {self.count}'
+
+
+class RequestStats:
+
+    def __init__(self, capture_statements):
+        self.started_at = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows_fetched = 0
+        self.rows_returned = 0
+        self.captured = [] if capture_statements else None
+
+
+class Metrics:
+    """Per-route request and SQL instrumentation.
+
+    init_app() registers SQLAlchemy engine events and Flask request hooks
+    and adds a /metrics route in the Prometheus text format. Nothing is
+    registered unless METRICS_ENABLED is set, so a disabled app pays no
+    cost at all. With SLOW_REQUEST_MS set, requests slower than that are
+    logged together with the SQL statements they ran.
+    """
+
+    histograms = (
+        ('trivia_request_duration_seconds',
+         'Request latency by route.', LATENCY_BUCKETS),
+        ('trivia_request_sql_statements',
+         'SQL statements issued per request.', STATEMENT_BUCKETS),
+        ('trivia_request_sql_duration_seconds',
+         'Time spent in SQL per request.', LATENCY_BUCKETS),
+    )
+    counters = (
+        ('trivia_requests_total', 'Requests by route, method and status.'),
+        ('trivia_sql_rows_fetched_total',
+         'Question and category rows read from the database by route.'),
+        ('trivia_response_rows_total',
+         'Questions returned in response bodies by route.'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listening = False
+        self.slow_request_ms = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {name: {} for name, _, _ in self.histograms}
+            self._counters = {name: {} for name, _ in self.counters}
+
+    def init_app(self, app):
+        if not app.config.get('METRICS_ENABLED'):
+            return
+        self.slow_request_ms = app.config.get('SLOW_REQUEST_MS')
+
+        # Listen on every engine: the app may be rebound to another
+        # database after init (see setup_db); statements outside an
+        # instrumented request are ignored.
+        if not self._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            event.listen(Mapper, 'load', self._after_load)
+            self._listening = True
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+
+    def _before_request(self):
+        g.request_stats = RequestStats(self.slow_request_ms is not None)
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        if has_request_context() and 'request_stats' in g:
+            context._query_started_at = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        if not (has_request_context() and 'request_stats' in g):
+            return
+        stats = g.request_stats
+        stats.statements += 1
+        stats.sql_seconds += time.perf_counter() - getattr(
+            context, '_query_started_at', time.perf_counter()
+        )
+        if stats.captured is not None:
+            stats.captured.append(statement)
+
+    def _after_load(self, instance, context):
+        record_rows(fetched=1)
+
+    def _after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started_at
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (('route', route),)
+
+        with self._lock:
+            self._observe('trivia_request_duration_seconds',
+                          labels, duration)
+            self._observe('trivia_request_sql_statements',
+                          labels, stats.statements)
+            self._observe('trivia_request_sql_duration_seconds',
+                          labels, stats.sql_seconds)
+            self._increment('trivia_requests_total', labels + (
+                ('method', request.method),
+                ('status', response.status_code)
+            ))
+            self._increment('trivia_sql_rows_fetched_total',
+                            labels, stats.rows_fetched)
+            self._increment('trivia_response_rows_total',
+                            labels, stats.rows_returned)
+
+        if stats.captured is not None \
+                and duration * 1000 >= self.slow_request_ms:
+            current_app.logger.warning(
+                'slow request %s %s: %.1f ms, %d statements\n%s',
+                request.method, request.full_path, duration * 1000,
+                stats.statements, '\n'.join(stats.captured)
+            )
+        return response
+
+    def _observe(self, name, labels, value):
+        buckets = next(b for n, _, b in self.histograms if n == name)
+        self._histograms[name].setdefault(labels, Histogram(buckets)) \
+            .observe(value)
+
+    def _increment(self, name, labels, value=1):
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, help_text, _ in self.histograms:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(self._histograms[name].items()):
+                    lines.extend(histogram.samples(name, labels))
+            for name, help_text in self.counters:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append(f'{name}{{{format_labels(labels)}}} {value}')
+        return Response(
+            '\n'.join(lines) + '\n',
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+
+metrics = Metrics()
@@ -0,0 +1,296 @@
+import random
+
+from models import db, Question, on_question_change
+from reloading import ReloadingCache
+from .answer_stats import answer_stats
+
+
+def category_key(category):
+    """Normalise a category id from the database or a request body."""
+    if category in (None, ''):
+        return None
+    try:
+        return int(category)
+    except (TypeError, ValueError):
+        return category
+
+
+class IdBucket:
+    """A set of ids that also supports O(1) uniform sampling.
+
+    Ids are kept in a list for random indexing plus a dict of positions
+    so that removal is a swap with the last element and a pop.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def add(self, question_id):
+        if question_id in self.positions:
+            return
+        self.positions[question_id] = len(self.ids)
+        self.ids.append(question_id)
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def sample(self, exclude=frozenset(), attempts=16):
+        """Return a random id not in `exclude`, or None if none is left.
+
+        Rejection sampling keeps this O(1) while few ids are excluded;
+        once a draw keeps hitting excluded ids the remaining candidates
+        are collected explicitly.
+        """
+        if not self.ids:
+            return None
+        for _ in range(attempts):
+            question_id = random.choice(self.ids)
+            if question_id not in exclude:
+                return question_id
+        remaining = [i for i in self.ids if i not in exclude]
+        return random.choice(remaining) if remaining else None
+
+
+class QuestionIndex(ReloadingCache):
+    """In-memory per-category aggregate of the questions table.
+
+    For every category it keeps the question ids as an IdBucket, a
+    histogram of the declared difficulties and, split further by
+    difficulty, one IdBucket per (category, difficulty), plus the same for
+    all questions together. The difficulty buckets let random_question()
+    aim at a target difficulty without a query per difficulty; they use
+    the difficulty observed from players' answers once a question has
+    enough of them (see flaskr.answer_stats), the declared one otherwise.
+
+    The index is built with a single (id, category, difficulty) query the
+    first time it is used, kept up to date from Question.insert()/delete(),
+    and rebuilt after `ttl` seconds to pick up writes made by other
+    processes.
+    """
+
+    # weight of a difficulty `n` steps away from the target is decay ** n
+    decay = 0.25
+
+    def __init__(self, ttl=300, difficulty_of=None):
+        super().__init__(ttl)
+        self.difficulty_of = difficulty_of
+        self._all = IdBucket()
+        self._declared = {}
+        self._categories = {}
+        self._histograms = {}
+        self._difficulties = {}
+        self._frozen = {}
+
+    def reload(self):
+        self._rebuild(db.session.query(
+            Question.id, Question.category, Question.difficulty
+            ).filter(Question.not_deleted()).all())
+
+    def _rebuild(self, rows):
+        """Replace the index with (id, category, difficulty) rows."""
+        with self._lock:
+            self._all = IdBucket()
+            self._declared = {}
+            self._frozen = {}
+            self._categories = {}
+            self._histograms = {}
+            self._difficulties = {}
+            for question_id, category, difficulty in rows:
+                self._add(question_id, category, difficulty)
+
+    def _histogram(self, category, difficulty, change):
+        for key in {None, category}:
+            histogram = self._histograms.setdefault(key, {})
+            histogram[difficulty] = histogram.get(difficulty, 0) + change
+            if not histogram[difficulty]:
+                del histogram[difficulty]
+
+    def _add(self, question_id, category, difficulty):
+        if question_id in self._all:
+            return
+        category = category_key(category)
+        self._all.add(question_id)
+        self._declared[question_id] = (category, difficulty)
+        self._frozen.pop(None, None)
+        self._frozen.pop(category, None)
+        self._categories.setdefault(category, IdBucket()).add(question_id)
+        self._histogram(category, difficulty, 1)
+        if self.difficulty_of is not None:
+            difficulty = self.difficulty_of(question_id, difficulty)
+        for key in {None, category}:
+            self._difficulties.setdefault(key, {}) \
+                .setdefault(difficulty, IdBucket()).add(question_id)
+
+    def _remove(self, question_id):
+        if question_id not in self._declared:
+            return
+        category, difficulty = self._declared.pop(question_id)
+        self._frozen.pop(None, None)
+        self._frozen.pop(category, None)
+        self._all.remove(question_id)
+        self._categories[category].remove(question_id)
+        self._histogram(category, difficulty, -1)
+        for key in {None, category}:
+            buckets = self._difficulties.get(key, {})
+            for bucket_difficulty, ids in list(buckets.items()):
+                if question_id in ids:
+                    ids.remove(question_id)
+                    if not ids:
+                        del buckets[bucket_difficulty]
+
+    def apply(self, action, questions):
+        """Question change listener, see models.on_question_change."""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            if action == 'insert':
+                for question in questions:
+                    self._add(question['id'], question['category'],
+                              question['difficulty'])
+            elif action == 'delete':
+                for question in questions:
+                    self._remove(question['id'])
+            else:
+                self._loaded_at = None
+
+    def bucket(self, category=None):
+        self._ensure_loaded()
+        category = category_key(category)
+        if category is None:
+            return self._all
+        return self._categories.get(category, IdBucket())
+
+    def frozen_ids(self, category=None):
+        """Return the ids in `category` as a tuple.
+
+        The tuple is shared by every caller until the category changes,
+        so long-lived readers such as quiz sessions need not copy it.
+        """
+        with self._lock:
+            bucket = self.bucket(category)
+            category = category_key(category)
+            ids = self._frozen.get(category)
+            if ids is None:
+                ids = self._frozen[category] = tuple(bucket.ids)
+            return ids
+
+    def count(self, category=None):
+        return len(self.bucket(category))
+
+    def difficulty_histogram(self, category=None):
+        """Return {declared difficulty: number of questions} for `category`."""
+        self._ensure_loaded()
+        return dict(self._histograms.get(category_key(category), {}))
+
+    def category_counts(self):
+        """Return {category: number of questions} for every category."""
+        self._ensure_loaded()
+        return {
+            category: len(bucket)
+            for category, bucket in self._categories.items()
+            if len(bucket)
+        }
+
+    def _sample_near(self, category, target, exclude):
+        """Draw an id, preferring difficulties close to `target`.
+
+        A difficulty is picked with weight decay ** distance from the
+        target (there are only a handful) and an id is drawn from its
+        bucket; difficulties with nothing left are dropped and the draw
+        repeated, so each question costs O(1).
+        """
+        self._ensure_loaded()
+        candidates = {
+            difficulty: bucket
+            for difficulty, bucket
+            in self._difficulties.get(category_key(category), {}).items()
+            if difficulty is not None
+        }
+        while candidates:
+            difficulties = list(candidates)
+            weights = [self.decay ** abs(difficulty - target)
+                       for difficulty in difficulties]
+            difficulty = random.choices(difficulties, weights)[0]
+            question_id = candidates[difficulty].sample(exclude)
+            if question_id is not None:
+                return question_id
+            del candidates[difficulty]
+        return None
+
+    def random_question(self, category=None, exclude=(),
+                        target_difficulty=None):
+        """Return a random Question in `category` whose id is not excluded.
+
+        With a `target_difficulty` questions of that difficulty are the
+        most likely and the odds fall off with the distance from it (see
+        `decay`); other difficulties are only served once the closer ones
+        run out.
+
+        Only the chosen row is read from the database, outside the lock.
+        If it has been deleted by another process just that id is dropped
+        from the index and another one is drawn.
+        """
+        exclude = set(exclude)
+        while True:
+            question_id = self.sample(category, exclude, target_difficulty)
+            if question_id is None:
+                return None
+            question = Question.get_live(question_id)
+            if question is not None:
+                return question
+            self.discard(question_id)
+            exclude.add(question_id)
+
+    def sample(self, category=None, exclude=frozenset(),
+               target_difficulty=None):
+        """Draw an id for random_question() without reading the row."""
+        with self._lock:
+            if target_difficulty is None:
+                return self.bucket(category).sample(exclude)
+            return self._sample_near(category, target_difficulty, exclude)
+
+    def discard(self, question_id):
+        """Drop an id found to be deleted from the index."""
+        with self._lock:
+            self._remove(question_id)
+
+
+def target_difficulty(histogram, target=None, curve=None, streak=None,
+                      served=0, step=0.5):
+    """Work out the difficulty to aim for from a /quiz request.
+
+    `curve` lists a difficulty per question of the game (the last one is
+    reused once the game is longer), otherwise `target` is used. A
+    `streak` (positive after consecutive right answers, negative after
+    wrong ones) moves the target `step` per answer, starting from the
+    middle of the available difficulties if nothing else was given. The
+    result is clamped to the difficulties in `histogram`; None means no
+    preference.
+    """
+    if curve:
+        target = curve[min(served, len(curve) - 1)]
+    known = [difficulty for difficulty in histogram if difficulty is not None]
+    if not known or (target is None and streak is None):
+        return None
+    low, high = min(known), max(known)
+    if target is None:
+        target = (low + high) / 2
+    target = float(target) + step * int(streak or 0)
+    return min(high, max(low, target))
+
+
+question_index = QuestionIndex(difficulty_of=answer_stats.effective_difficulty)
+on_question_change(question_index.apply)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from models import Question
+from .cache import LocalCacheBackend
+from .question_index import question_index
+
+
+class QuizSession:
+    """The questions left to serve in one game.
+
+    `ids` is shuffled lazily: each call to next_id() swaps a random id
+    from the unserved tail into place at `cursor`, one Fisher-Yates step
+    at a time, so serving a question is O(1) and no set of previous
+    questions has to be kept or sent. `ids` itself is the tuple shared
+    with every other session over the same questions; the swaps are
+    recorded in `moved`, which only ever holds as many entries as
+    questions served.
+    """
+
+    def __init__(self, category, ids, ids_key, cursor=0, moved=None):
+        self.category = category
+        self.ids = ids
+        self.ids_key = ids_key
+        self.moved = moved if moved is not None else {}
+        self.cursor = cursor
+
+    @property
+    def remaining(self):
+        return len(self.ids) - self.cursor
+
+    def _at(self, position):
+        return self.moved.get(position, self.ids[position])
+
+    def next_id(self):
+        if self.cursor >= len(self.ids):
+            return None
+        swap = random.randrange(self.cursor, len(self.ids))
+        question_id = self._at(swap)
+        if swap != self.cursor:
+            self.moved[swap] = self._at(self.cursor)
+        self.moved.pop(self.cursor, None)
+        self.cursor += 1
+        return question_id
+
+    def dumps(self):
+        return json.dumps({
+            'category': self.category,
+            'ids': self.ids_key,
+            'cursor': self.cursor,
+            'moved': list(self.moved.items())
+        }, separators=(',', ':')).encode()
+
+
+class QuizSessionStore:
+    """Quiz sessions keyed by an opaque token, kept in a CacheBackend.
+
+    With a shared backend (see flaskr.cache) every worker and node serves
+    every session; by default each process keeps its own sessions in a
+    local LRU of `max_sessions` entries. A session expires once idle for
+    `ttl` seconds.
+
+    A session is stored as its cursor and swaps plus the key of its id
+    list. Id lists are stored once per distinct list under a digest of
+    their contents, kept for `ttl` seconds after the last session over
+    them started, and decoded at most once per process. Drawing the next
+    id holds a per-session lock taken with CacheBackend.add(), so
+    concurrent requests for one session never serve the same question.
+    """
+
+    poll_interval = 0.01
+
+    def __init__(self, backend=None, ttl=3600, max_sessions=100000,
+                 lock_timeout=5):
+        self.backend = backend if backend is not None \
+            else LocalCacheBackend(max_sessions)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._ids = OrderedDict()
+        self._ids_lock = threading.Lock()
+
+    def _remember_ids(self, ids_key, ids):
+        with self._ids_lock:
+            self._ids[ids_key] = ids
+            self._ids.move_to_end(ids_key)
+            while len(self._ids) > 64:
+                self._ids.popitem(last=False)
+
+    def _store_ids(self, ids):
+        data = array('q', ids).tobytes()
+        ids_key = 'quiz:ids:' + hashlib.blake2b(data, digest_size=16) \
+            .hexdigest()
+        self.backend.set(ids_key, data, self.ttl)
+        self._remember_ids(ids_key, ids)
+        return ids_key
+
+    def _load_ids(self, ids_key):
+        ids = self._ids.get(ids_key)
+        if ids is None:
+            data = self.backend.get(ids_key)
+            if data is None:
+                return None
+            ids = tuple(array('q', data))
+        self._remember_ids(ids_key, ids)
+        return ids
+
+    def _load(self, token):
+        data = self.backend.get('quiz:session:' + token)
+        if data is None:
+            return None
+        state = json.loads(data)
+        ids = self._load_ids(state['ids'])
+        if ids is None:
+            return None
+        return QuizSession(state['category'], ids, state['ids'],
+                           state['cursor'], dict(state['moved']))
+
+    def _save(self, token, session):
+        self.backend.set('quiz:session:' + token, session.dumps(), self.ttl)
+
+    def start(self, category=None):
+        """Open a session over the questions currently in `category`."""
+        ids = question_index.frozen_ids(category)
+        session = QuizSession(category, ids, self._store_ids(ids))
+        token = secrets.token_urlsafe(16)
+        self._save(token, session)
+        return token, session
+
+    def get(self, token):
+        session = self._load(token)
+        if session is not None:
+            self._save(token, session)
+        return session
+
+    def end(self, token):
+        if self.backend.get('quiz:session:' + token) is None:
+            return False
+        self.backend.delete('quiz:session:' + token)
+        return True
+
+    def _draw(self, token):
+        """Advance the session one question while holding its lock.
+
+        The lock expires after `lock_timeout` seconds, so a worker that
+        dies holding it delays the session rather than blocking it.
+        """
+        lock_key = 'quiz:lock:' + token
+        while not self.backend.add(lock_key, b'1', self.lock_timeout):
+            time.sleep(self.poll_interval)
+        try:
+            session = self._load(token)
+            if session is None:
+                return None, None
+            question_id = session.next_id()
+            self._save(token, session)
+            return session, question_id
+        finally:
+            self.backend.delete(lock_key)
+
+    def next_question(self, token):
+        """Return (session, question) for the next unserved question.
+
+        `session` is None for an unknown or expired token and `question`
+        is None once every question in the session has been served.
+        Questions deleted since the session started are skipped. Only
+        drawing the id holds the session's lock; the row is read without
+        it.
+        """
+        while True:
+            session, question_id = self._draw(token)
+            if question_id is None:
+                return session, None
+            question = Question.get_live(question_id)
+            if question is not None:
+                return session, question
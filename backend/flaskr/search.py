@@ -0,0 +1,206 @@
+import weakref
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Question, on_question_change
+from reloading import ReloadingCache
+
+
+def escape_like(term):
+    """Escape LIKE wildcards so the search term is matched literally."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class SearchBackend:
+    """Finds questions whose text contains a search term.
+
+    search() returns the ids of one page of matches, best match first,
+    together with the total number of matches; iter_ids() yields the ids
+    of every match in the same order.
+    """
+
+    def search(self, term, page=1, per_page=10):
+        raise NotImplementedError
+
+    def iter_ids(self, term):
+        raise NotImplementedError
+
+    def apply(self, action, questions):
+        """Question change listener, see models.on_question_change."""
+
+    def rebuild(self):
+        """Rebuild the index from the questions table."""
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Substring search served by a pg_trgm GIN index.
+
+    A trigram index lets PostgreSQL answer ILIKE '%term%' with a bitmap
+    index scan instead of a sequential scan, so matching stays the same
+    as before while results are ranked by word_similarity(). The index is
+    created by migration 4 in migrations.py.
+    """
+
+    def _matches(self, term):
+        return Question.query.filter(
+            Question.question.ilike(f'%{escape_like(term)}%', escape='\\'),
+            Question.not_deleted()
+            )
+
+    def _ranked_ids(self, term):
+        return self._matches(term).with_entities(Question.id).order_by(
+            func.word_similarity(term, Question.question).desc(),
+            Question.id
+            )
+
+    def search(self, term, page=1, per_page=10):
+        total = self._matches(term).count()
+        rows = self._ranked_ids(term) \
+            .offset((page - 1) * per_page).limit(per_page).all()
+        return [question_id for question_id, in rows], total
+
+    def rebuild(self):
+        db.session.execute('REINDEX INDEX ix_questions_question_trgm')
+        db.session.commit()
+
+    def iter_ids(self, term, batch_size=500):
+        rows = self._ranked_ids(term) \
+            .execution_options(stream_results=True).yield_per(batch_size)
+        for question_id, in rows:
+            yield question_id
+
+
+class MemorySearchBackend(SearchBackend, ReloadingCache):
+    """Pure-Python trigram inverted index for SQLite and tests.
+
+    Candidates are the intersection of the posting sets of the term's
+    trigrams and are then checked for a real substring match, giving the
+    same results as ILIKE '%term%'. The index is built on first use,
+    updated from Question.insert()/delete(), and rebuilt after `ttl`
+    seconds to pick up writes from other processes.
+    """
+
+    def __init__(self, ttl=300):
+        super().__init__(ttl)
+        self._texts = {}
+        self._postings = {}
+
+    def reload(self):
+        rows = db.session.query(Question.id, Question.question) \
+            .filter(Question.not_deleted()).all()
+        self._texts = {}
+        self._postings = {}
+        for question_id, question in rows:
+            self._add(question_id, question)
+
+    def rebuild(self):
+        with self._lock:
+            self.invalidate()
+            self._ensure_loaded()
+
+    def _add(self, question_id, question):
+        value = (question or '').casefold()
+        self._texts[question_id] = value
+        for trigram in trigrams(value):
+            self._postings.setdefault(trigram, set()).add(question_id)
+
+    def _remove(self, question_id):
+        value = self._texts.pop(question_id, None)
+        if value is None:
+            return
+        for trigram in trigrams(value):
+            posting = self._postings.get(trigram)
+            if posting is not None:
+                posting.discard(question_id)
+                if not posting:
+                    del self._postings[trigram]
+
+    def apply(self, action, questions):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            if action == 'insert':
+                for question in questions:
+                    self._add(question['id'], question['question'])
+            elif action == 'delete':
+                for question in questions:
+                    self._remove(question['id'])
+            else:
+                self._loaded_at = None
+
+    def _rank(self, question_id, term):
+        value = self._texts[question_id]
+        position = value.find(term)
+        end = position + len(term)
+        whole_word = (position == 0 or not value[position - 1].isalnum()) \
+            and (end == len(value) or not value[end].isalnum())
+        return (not whole_word, position, len(value), question_id)
+
+    def _ranked_ids(self, term):
+        term = term.casefold()
+        with self._lock:
+            self._ensure_loaded()
+            postings = sorted(
+                (self._postings.get(trigram, set())
+                 for trigram in trigrams(term)),
+                key=len
+                )
+            if postings:
+                candidates = set.intersection(*postings) if postings[0] \
+                    else set()
+            else:
+                candidates = self._texts.keys()
+            matches = [
+                question_id for question_id in candidates
+                if term in self._texts[question_id]
+            ]
+            matches.sort(key=lambda question_id: self._rank(question_id, term))
+        return matches
+
+    def search(self, term, page=1, per_page=10):
+        matches = self._ranked_ids(term)
+        start = (page - 1) * per_page
+        return matches[start:start + per_page], len(matches)
+
+    def iter_ids(self, term):
+        return iter(self._ranked_ids(term))
+
+
+backends = {
+    'postgres': PostgresSearchBackend,
+    'memory': MemorySearchBackend,
+}
+
+_backends = weakref.WeakSet()
+
+
+def get_search_backend():
+    """Return the search backend for the current app.
+
+    SEARCH_BACKEND in the app config picks one of `backends`; by default
+    PostgreSQL gets the trigram index and every other database the
+    in-memory index. The backend is created on first use and kept in
+    app.extensions['search'].
+    """
+    backend = current_app.extensions.get('search')
+    if backend is None:
+        name = current_app.config.get('SEARCH_BACKEND')
+        if name is None:
+            name = 'postgres' if db.engine.dialect.name == 'postgresql' \
+                else 'memory'
+        backend = current_app.extensions.setdefault(
+            'search', backends[name]()
+        )
+        _backends.add(backend)
+    return backend
+
+
+@on_question_change
+def _update_search_index(action, questions):
+    for backend in list(_backends):
+        backend.apply(action, questions)
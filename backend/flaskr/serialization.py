@@ -0,0 +1,54 @@
+import json
+
+from flask import Response
+
+from models import db, Question
+from .metrics import record_rows
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+
+def stdlib_dumps(payload):
+    """Serialise exactly like Flask's jsonify (sorted, compact, ASCII)."""
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':'))
+            + '\n').encode()
+
+
+def orjson_dumps(payload):
+    """orjson, falling back to the stdlib for non-ASCII output.
+
+    orjson always writes UTF-8 while jsonify escapes non-ASCII characters,
+    so those (rare) payloads go through json to keep the bytes identical.
+    """
+    body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    if not body.isascii():
+        return stdlib_dumps(payload)
+    return body + b'\n'
+
+
+dumps = orjson_dumps if orjson is not None else stdlib_dumps
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def question_query():
+    """Query the question columns as plain tuples, skipping the ORM.
+
+    Soft-deleted questions are left out.
+    """
+    return db.session.query(*QUESTION_COLUMNS).filter(Question.not_deleted())
+
+
+def question_dicts(rows):
+    """Turn question_query() rows into Question.format()-shaped dicts."""
+    questions = [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+    record_rows(fetched=len(questions))
+    return questions
@@ -0,0 +1,487 @@
+"""
+Read-only snapshots of the question bank.
+
+A snapshot compiles the questions and categories tables into one
+binary file that read-only nodes memory-map (see SNAPSHOT_PATH in
+config.py), so they serve /questions, /categories/<id>/questions and
+/quiz without a database. Every worker process maps the same file and
+shares its pages through the OS page cache.
+
+Snapshots are written with `python snapshot.py export` or the
+export_snapshot job (flaskr.jobs).
+
+Layout (little-endian, sections aligned to 8 bytes):
+
+    header       HEADER, including the offset of every section
+    ids          int32[n], question ids in ascending order
+    categories   int32[n], category of each question (0 for none)
+    difficulties int32[n], difficulty of each question (0 for none)
+    empirical    int32[n], empirical difficulty of each question in
+                 hundredths (see AnswerStats.difficulty())
+    order        int32[n], question positions sorted by (category,
+                 difficulty, id)
+    category_ids int32[k], category ids in ascending order
+    buckets      int32[b][4], (category, difficulty, start, end) ranges
+                 of `order`, sorted by category and difficulty
+    offsets      uint64[2n + k + 1], start of every string in `strings`
+    strings      UTF-8 question and answer of each question, then the
+                 type of each category
+"""
+import bisect
+import mmap
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from itertools import accumulate, groupby
+
+from flask import abort, g, jsonify, request
+from sqlalchemy import select
+
+from models import Category, Question, QuestionStats
+from .answer_stats import answer_stats
+from .question_index import category_key, target_difficulty
+
+MAGIC = b'TRIVSNAP'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIIQIIII9Q')
+QUESTIONS_PER_PAGE = 10
+
+
+def _padding(size):
+    return -size % 8
+
+
+class RangeBucket:
+    """Positions in a snapshot's `order` array, sampled like an IdBucket."""
+
+    def __init__(self, snapshot, ranges):
+        self.snapshot = snapshot
+        self.ranges = ranges
+        self.ends = list(accumulate(end - start for start, end in ranges))
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, index):
+        bucket = bisect.bisect_right(self.ends, index)
+        start = self.ranges[bucket][0]
+        offset = index - (self.ends[bucket - 1] if bucket else 0)
+        return self.snapshot.order[start + offset]
+
+    def sample(self, exclude=frozenset(), attempts=16):
+        """Return a random position whose question id is not excluded."""
+        ids = self.snapshot.ids
+        if not len(self):
+            return None
+        for _ in range(attempts):
+            position = self[random.randrange(len(self))]
+            if ids[position] not in exclude:
+                return position
+        remaining = [self[i] for i in range(len(self))
+                     if ids[self[i]] not in exclude]
+        return random.choice(remaining) if remaining else None
+
+
+class Snapshot:
+    """A snapshot file mapped into memory.
+
+    The arrays are memoryviews over the mapping, so opening a snapshot
+    reads nothing but the header and every lookup touches only the
+    pages it needs.
+    """
+
+    # weight of a difficulty `n` steps away from the target is decay ** n,
+    # as in QuestionIndex
+    decay = 0.25
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError('snapshots can only be read on little-endian hosts')
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        (magic, format_version, _, self.version, count, category_count,
+         bucket_count, string_count, *offsets) = \
+            HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} '
+                             'question snapshot')
+        view = memoryview(self._mmap)
+
+        def section(index, length, code):
+            start = offsets[index]
+            return view[start:start + length * struct.calcsize(code)] \
+                .cast(code)
+
+        self.ids = section(0, count, 'i')
+        self.categories = section(1, count, 'i')
+        self.difficulties = section(2, count, 'i')
+        self.empirical = section(3, count, 'i')
+        self.order = section(4, count, 'i')
+        self.category_ids = section(5, category_count, 'i')
+        self.buckets = section(6, bucket_count * 4, 'i')
+        self.offsets = section(7, string_count + 1, 'Q')
+        self.strings = view[offsets[8]:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _string(self, index):
+        return str(
+            self.strings[self.offsets[index]:self.offsets[index + 1]],
+            'utf-8'
+        )
+
+    def question(self, position):
+        """The question at `position`, shaped like Question.format()."""
+        return {
+            'id': self.ids[position],
+            'question': self._string(2 * position),
+            'answer': self._string(2 * position + 1),
+            'category': self.categories[position] or None,
+            'difficulty': self.difficulties[position] or None
+        }
+
+    def listed_question(self, position):
+        """question() plus the empirical difficulty, as /questions lists."""
+        question = self.question(position)
+        question['empirical_difficulty'] = self.empirical[position] / 100
+        return question
+
+    def type_of(self, category_id):
+        index = bisect.bisect_left(self.category_ids, category_id)
+        if index < len(self.category_ids) \
+                and self.category_ids[index] == category_id:
+            return self._string(2 * len(self) + index)
+        return None
+
+    def page(self, page, per_page=QUESTIONS_PER_PAGE):
+        start = (page - 1) * per_page
+        return [self.listed_question(position) for position
+                in range(start, min(start + per_page, len(self)))]
+
+    def after(self, after_id, per_page=QUESTIONS_PER_PAGE):
+        start = bisect.bisect_right(self.ids, after_id)
+        return [self.listed_question(position) for position
+                in range(start, min(start + per_page, len(self)))]
+
+    def difficulty_buckets(self, category=None):
+        """{difficulty: RangeBucket} for `category` (None for all)."""
+        ranges = {}
+        for index in range(0, len(self.buckets), 4):
+            bucket_category, difficulty, start, end = \
+                self.buckets[index:index + 4]
+            if category is None or bucket_category == category:
+                ranges.setdefault(difficulty or None, []).append((start, end))
+        return {
+            difficulty: RangeBucket(self, bucket_ranges)
+            for difficulty, bucket_ranges in ranges.items()
+        }
+
+    def category_questions(self, category):
+        positions = sorted(
+            position
+            for bucket in self.difficulty_buckets(category).values()
+            for position in (bucket[i] for i in range(len(bucket)))
+        )
+        return [self.question(position) for position in positions]
+
+    def random_question(self, category=None, exclude=(), target=None):
+        """A random question in `category` whose id is not excluded.
+
+        Mirrors QuestionIndex.random_question(), including the preference
+        for difficulties close to `target`.
+        """
+        exclude = set(exclude)
+        candidates = self.difficulty_buckets(category)
+        if target is None:
+            candidates = {
+                None: RangeBucket(self, [
+                    bucket_range for bucket in candidates.values()
+                    for bucket_range in bucket.ranges
+                ])
+            }
+        else:
+            candidates.pop(None, None)
+        while candidates:
+            difficulties = list(candidates)
+            weights = [1 if target is None
+                       else self.decay ** abs(difficulty - target)
+                       for difficulty in difficulties]
+            difficulty = random.choices(difficulties, weights)[0]
+            position = candidates[difficulty].sample(exclude)
+            if position is not None:
+                return self.question(position)
+            del candidates[difficulty]
+        return None
+
+
+class SnapshotStore:
+    """The current snapshot at `path`, reloaded when the file is replaced.
+
+    The file is checked at most every `check_interval` seconds; a new
+    file (see write_snapshot(), which replaces it atomically) is mapped
+    and swapped in when it carries a different version. Requests still
+    using the previous mapping keep it until they finish. get() returns
+    None until the file first exists; if it is removed later the last
+    mapped snapshot is kept.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stat = None
+        self._checked_at = None
+
+    def get(self):
+        if self._checked_at is not None \
+                and time.monotonic() - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self._checked_at = time.monotonic()
+                return self._snapshot
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if key != self._stat:
+                snapshot = Snapshot(self.path)
+                if self._snapshot is None \
+                        or snapshot.version != self._snapshot.version:
+                    self._snapshot = snapshot
+                self._stat = key
+            self._checked_at = time.monotonic()
+        return self._snapshot
+
+
+def write_snapshot(connection, path, version=None):
+    """Compile the questions and categories into a snapshot at `path`.
+
+    Questions are read through a server-side cursor and their text is
+    spooled to a temporary file, so only the integer columns are held in
+    memory. The snapshot is written next to `path` and renamed over it,
+    so readers never see a partial file. Returns (version, questions).
+    """
+    if version is None:
+        version = time.time_ns() // 1000000
+    questions = Question.__table__.c
+    categories = Category.__table__.c
+    stats = QuestionStats.__table__.c
+
+    category_rows = connection.execute(
+        select([categories.id, categories.type]).order_by(categories.id)
+    ).fetchall()
+    rows = connection.execution_options(stream_results=True).execute(
+        select([questions.id, questions.question, questions.answer,
+                questions.category, questions.difficulty,
+                stats.correct, stats.wrong])
+        .select_from(Question.__table__.outerjoin(
+            QuestionStats.__table__, stats.question_id == questions.id))
+        .where(questions.deleted_at.is_(None))
+        .order_by(questions.id)
+    )
+
+    ids, question_categories, difficulties = array('i'), array('i'), array('i')
+    empirical = array('i')
+    offsets = array('Q', [0])
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as strings:
+        def add_string(value):
+            data = (value or '').encode('utf-8')
+            strings.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+        for question_id, question, answer, category, difficulty, \
+                correct, wrong in rows:
+            ids.append(question_id)
+            question_categories.append(category or 0)
+            difficulties.append(difficulty or 0)
+            empirical.append(round(100 * answer_stats.difficulty_from(
+                difficulty, correct or 0, wrong or 0)))
+            add_string(question)
+            add_string(answer)
+        category_ids = array('i')
+        for category_id, category_type in category_rows:
+            category_ids.append(category_id)
+            add_string(category_type)
+
+        def bucket_key(position):
+            return question_categories[position], difficulties[position]
+
+        order = array('i', sorted(range(len(ids)), key=bucket_key))
+        buckets = array('i')
+        start = 0
+        for (category, difficulty), positions in groupby(order, bucket_key):
+            end = start + sum(1 for _ in positions)
+            buckets.extend((category, difficulty, start, end))
+            start = end
+
+        sections = [ids, question_categories, difficulties, empirical, order,
+                    category_ids, buckets, offsets]
+        section_offsets = []
+        position = HEADER.size + _padding(HEADER.size)
+        for section in sections:
+            section_offsets.append(position)
+            size = len(section) * section.itemsize
+            position += size + _padding(size)
+        section_offsets.append(position)
+
+        handle, temporary_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                output.write(HEADER.pack(
+                    MAGIC, FORMAT_VERSION, 0, version, len(ids),
+                    len(category_ids), len(buckets) // 4, len(offsets) - 1,
+                    *section_offsets
+                ))
+                output.write(b'\0' * _padding(HEADER.size))
+                for section in sections:
+                    if sys.byteorder != 'little':
+                        section.byteswap()
+                    data = section.tobytes()
+                    output.write(data)
+                    output.write(b'\0' * _padding(len(data)))
+                strings.seek(0)
+                shutil.copyfileobj(strings, output)
+                output.flush()
+                os.fsync(output.fileno())
+            # mkstemp creates the file 0600; nodes may run as another user
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+    return version, len(ids)
+
+
+def snapshot_routes(app):
+    """Register the read-only routes served from SNAPSHOT_PATH."""
+    store = SnapshotStore(app.config['SNAPSHOT_PATH'],
+                          app.config.get('SNAPSHOT_CHECK_INTERVAL', 1.0))
+    app.extensions['snapshot'] = store
+
+    def current_snapshot():
+        """The snapshot this request is served from, kept on `g`."""
+        if 'snapshot' not in g:
+            g.snapshot = store.get()
+        if g.snapshot is None:
+            abort(503)
+        return g.snapshot
+
+    @app.after_request
+    def snapshot_etag(response):
+        # the snapshot version changes whenever the content may have; use
+        # the one the view read, a reload may have happened since
+        snapshot = g.get('snapshot')
+        if snapshot is not None and request.method == 'GET' \
+                and response.status_code == 200:
+            response.set_etag(str(snapshot.version))
+            response.make_conditional(request)
+        return response
+
+    @app.route('/categories')
+    def get_categories():
+        categories = list(current_snapshot().category_ids)
+        if not categories:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'categories': categories
+        })
+
+    @app.route('/questions')
+    def get_questions():
+        snapshot = current_snapshot()
+        page = request.args.get('page', 1, type=int)
+        after_id = request.args.get('after_id', type=int)
+
+        total_questions = len(snapshot)
+        if not total_questions:
+            abort(404)
+
+        if after_id is not None:
+            questions = snapshot.after(after_id)
+            if not questions:
+                abort(404)
+        else:
+            max_page = -(-total_questions // QUESTIONS_PER_PAGE)
+            if page < 1 or page > max_page:
+                abort(404)
+            questions = snapshot.page(page)
+
+        response = {
+            'success': True,
+            'questions': questions,
+            'total_questions': total_questions,
+            'categories': list(snapshot.category_ids),
+            'current_category': snapshot.type_of(questions[0]['category'])
+        }
+        if after_id is not None:
+            response['next_after_id'] = \
+                questions[-1]['id'] \
+                if len(questions) == QUESTIONS_PER_PAGE else None
+
+        return jsonify(response)
+
+    @app.route('/categories/<int:category_id>/questions')
+    def get_questions_by_category(category_id):
+        snapshot = current_snapshot()
+        # the frontend counts categories from 0, see create_app()
+        category_id += 1
+
+        current_category = snapshot.type_of(category_id)
+        questions = snapshot.category_questions(category_id)
+        if current_category is None or not questions:
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'questions': questions,
+            'total_questions': len(questions),
+            'current_category': current_category
+        })
+
+    @app.route('/quiz', methods=['POST'])
+    def get_random_quiz():
+        snapshot = current_snapshot()
+        body = request.get_json(silent=True)
+        try:
+            category_id = category_key(body['quiz_category']['id'] or None)
+            previous_questions = body['previous_questions'] or ()
+            histogram = {
+                difficulty: len(bucket) for difficulty, bucket
+                in snapshot.difficulty_buckets(category_id).items()
+            }
+            target = target_difficulty(
+                histogram,
+                target=body.get('target_difficulty'),
+                curve=body.get('difficulty_curve'),
+                streak=body.get('streak'),
+                served=len(previous_questions)
+                )
+            question = snapshot.random_question(
+                category_id, exclude=previous_questions, target=target
+                )
+        except (KeyError, TypeError, ValueError):
+            abort(422)
+        if question is None:
+            abort(422)
+
+        response = {
+            'success': True,
+            'question': question
+        }
+        if target is not None:
+            response['target_difficulty'] = target
+        return jsonify(response)
+
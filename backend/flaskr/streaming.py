@@ -0,0 +1,87 @@
+from itertools import chain, islice
+
+from flask import request, Response, stream_with_context
+
+from .serialization import dumps, question_dicts
+
+STREAM_BATCH_SIZE = 500
+
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+def stream_mode():
+    """Return 'ndjson', 'json' or None for the current request.
+
+    Streaming is requested with ?stream=ndjson|json, or for NDJSON with
+    an `Accept: application/x-ndjson` header.
+    """
+    mode = request.args.get('stream')
+    if mode is None and request.accept_mimetypes.best == STREAM_MIMETYPES['ndjson']:
+        mode = 'ndjson'
+    if mode is not None and mode not in STREAM_MIMETYPES:
+        return None
+    return mode
+
+
+def batched(iterable, size=STREAM_BATCH_SIZE):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_rows(query, batch_size=STREAM_BATCH_SIZE):
+    """Yield question dicts from a question_query() via a server-side cursor."""
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+    for batch in batched(rows, batch_size):
+        yield from question_dicts(batch)
+
+
+def ndjson_body(questions):
+    for batch in batched(questions):
+        yield b''.join(dumps(question) for question in batch)
+
+
+def json_body(questions, head, tail):
+    """Yield a JSON object whose 'questions' array is written row by row.
+
+    `head` holds the keys that sort before 'questions' and `tail(count)`
+    returns the keys that sort after it, so the bytes match a non-streamed
+    json_response() of the same payload.
+    """
+    prefix = dumps(head)[:-2]
+    yield prefix + (b',' if len(prefix) > 1 else b'') + b'"questions":['
+    count = 0
+    for batch in batched(questions):
+        chunk = b','.join(dumps(question)[:-1] for question in batch)
+        yield (b',' if count else b'') + chunk
+        count += len(batch)
+    yield b'],' + dumps(tail(count))[1:]
+
+
+def stream_questions(mode, questions, head=None, tail=None):
+    """Build a streamed response for an iterator of question dicts.
+
+    With mode 'ndjson' each question is written as one line; with 'json'
+    the usual response object is written incrementally. Either way rows
+    are sent as they are read, so memory stays flat for any result size.
+    """
+    if mode == 'ndjson':
+        body = ndjson_body(questions)
+    else:
+        body = json_body(questions, head or {}, tail or (lambda count: {}))
+    return Response(stream_with_context(body),
+                    mimetype=STREAM_MIMETYPES[mode])
+
+
+def peek(iterator):
+    """Return (first item or None, iterator yielding all items)."""
+    iterator = iter(iterator)
+    for first in iterator:
+        return first, chain([first], iterator)
+    return None, iter(())
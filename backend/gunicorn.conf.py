@@ -0,0 +1,36 @@
+"""
+gunicorn settings for the trivia API:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported and built once in the master (preload_app) and the
+workers are forked from it, so they start without importing Flask and
+SQLAlchemy again. create_app() opens no database connection and issues
+no DDL (see SCHEMA_CREATE in config.py), so nothing connection-related
+is inherited across the fork; post_fork() still drops any pool the
+master may have created. Set GUNICORN_PRELOAD=0 to load the app in each
+worker instead, e.g. to pick up code changes with a HUP.
+
+Workers only share quiz sessions (and cached responses) through a shared
+cache backend; set REDIS_URL when running more than one.
+Background jobs are only queued here; run `python worker.py` next to it.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'flaskr:create_app()'
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get(
+    'GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1
+))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from models import db
+    app = server.app.wsgi()
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind=bind).dispose()
@@ -0,0 +1,272 @@
+"""
+Versioned schema migrations for the trivia database.
+
+Each migration runs once, in its own transaction, and is recorded in the
+schema_migrations table:
+
+    python migrations.py upgrade     # apply pending migrations
+    python migrations.py status      # list applied and pending migrations
+    python migrations.py check       # report missing indexes (exit 1)
+
+The database defaults to DATABASE_URL or models.database_path; pass
+--database-url to target another one.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, text
+
+from models import database_path, Question
+
+POSTGRES_SEARCH_INDEX_DDL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_questions_question_trgm '
+    'ON questions USING gin (question gin_trgm_ops)',
+]
+
+
+class Migration:
+
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+def create_tables(connection):
+    """Create the categories and questions tables if they do not exist.
+
+    This is the baseline schema, written out rather than taken from the
+    models so it stays fixed; later model changes get migrations of their
+    own.
+    """
+    if connection.dialect.name == 'postgresql':
+        primary_key = 'id SERIAL PRIMARY KEY'
+    else:
+        primary_key = 'id INTEGER PRIMARY KEY'
+    connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS categories ('
+        f'{primary_key}, '
+        'type VARCHAR)'
+    ))
+    connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS questions ('
+        f'{primary_key}, '
+        'question VARCHAR, '
+        'answer VARCHAR, '
+        'category INTEGER REFERENCES categories (id) '
+        'ON UPDATE CASCADE ON DELETE SET NULL, '
+        'difficulty INTEGER)'
+    ))
+
+
+def category_integer_foreign_key(connection):
+    """Make questions.category an integer referencing categories.id.
+
+    Databases loaded from trivia.psql already have this. SQLite cannot
+    alter column types, so there the table keeps whatever it was created
+    with (migration 1 creates it correctly).
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    inspector = inspect(connection)
+    columns = {c['name']: c for c in inspector.get_columns('questions')}
+    if columns['category']['type'].python_type is not int:
+        connection.execute(text(
+            'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+            'USING NULLIF(category, \'\')::integer'
+        ))
+    if not any(fk['referred_table'] == 'categories'
+               for fk in inspector.get_foreign_keys('questions')):
+        connection.execute(text(
+            'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+            'FOREIGN KEY (category) REFERENCES categories (id) '
+            'ON UPDATE CASCADE ON DELETE SET NULL'
+        ))
+
+
+def category_indexes(connection):
+    """Composite indexes for category listings and the quiz picker."""
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_id '
+        'ON questions (category, id)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty '
+        'ON questions (category, difficulty)'
+    ))
+
+
+def question_search_index(connection):
+    """Trigram index serving /search on PostgreSQL (see flaskr.search)."""
+    if connection.dialect.name != 'postgresql':
+        return
+    for statement in POSTGRES_SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+
+
+def create_quiz_results(connection):
+    """Table and leaderboard indexes for quiz results."""
+    if connection.dialect.name == 'postgresql':
+        primary_key = 'id SERIAL PRIMARY KEY'
+    else:
+        primary_key = 'id INTEGER PRIMARY KEY'
+    connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS quiz_results ('
+        f'{primary_key}, '
+        'player VARCHAR NOT NULL, '
+        'category INTEGER REFERENCES categories (id) '
+        'ON UPDATE CASCADE ON DELETE CASCADE, '
+        'score INTEGER NOT NULL, '
+        'total_questions INTEGER NOT NULL, '
+        'submitted_at TIMESTAMP NOT NULL)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_quiz_results_score '
+        'ON quiz_results (score DESC, submitted_at)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_quiz_results_category_score '
+        'ON quiz_results (category, score DESC, submitted_at)'
+    ))
+
+
+def create_question_stats(connection):
+    """Per-question answer counters (see flaskr.answer_stats)."""
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS question_stats ('
+        'question_id INTEGER PRIMARY KEY REFERENCES questions (id) '
+        'ON UPDATE CASCADE ON DELETE CASCADE, '
+        'served INTEGER NOT NULL, '
+        'correct INTEGER NOT NULL, '
+        'wrong INTEGER NOT NULL)'
+    ))
+
+
+def question_soft_delete(connection):
+    """questions.deleted_at tombstones and the index the purge job scans.
+
+    Databases created with db.create_all() already have the column. The
+    index is partial on PostgreSQL since only deleted rows are scanned.
+    """
+    inspector = inspect(connection)
+    if 'deleted_at' not in {c['name']
+                            for c in inspector.get_columns('questions')}:
+        connection.execute(text(
+            'ALTER TABLE questions ADD COLUMN deleted_at TIMESTAMP'
+        ))
+    statement = 'CREATE INDEX IF NOT EXISTS ix_questions_deleted_at ' \
+        'ON questions (deleted_at)'
+    if connection.dialect.name == 'postgresql':
+        statement += ' WHERE deleted_at IS NOT NULL'
+    connection.execute(text(statement))
+
+
+MIGRATIONS = [
+    Migration(1, 'create categories and questions', create_tables),
+    Migration(2, 'questions.category integer foreign key',
+              category_integer_foreign_key),
+    Migration(3, 'category (id) and (difficulty) indexes', category_indexes),
+    Migration(4, 'question text search index', question_search_index),
+    Migration(5, 'create quiz_results', create_quiz_results),
+    Migration(6, 'create question_stats', create_question_stats),
+    Migration(7, 'questions.deleted_at soft delete', question_soft_delete),
+]
+
+
+def ensure_migrations_table(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, '
+        'description VARCHAR NOT NULL, '
+        'applied_at TIMESTAMP NOT NULL)'
+    ))
+
+
+def applied_versions(engine):
+    with engine.begin() as connection:
+        ensure_migrations_table(connection)
+        rows = connection.execute(text('SELECT version FROM schema_migrations'))
+        return {version for version, in rows}
+
+
+def pending_migrations(engine):
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def upgrade(engine):
+    """Apply every pending migration; returns the ones applied."""
+    applied = []
+    for migration in pending_migrations(engine):
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(
+                text('INSERT INTO schema_migrations '
+                     '(version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.utcnow()
+            )
+        applied.append(migration)
+    return applied
+
+
+def expected_indexes(dialect_name):
+    """{index name: columns} that the queries in flaskr rely on."""
+    expected = {
+        index.name: [column.name for column in index.columns]
+        for index in Question.__table__.indexes
+    }
+    if dialect_name == 'postgresql':
+        expected['ix_questions_question_trgm'] = ['question']
+    return expected
+
+
+def missing_indexes(engine):
+    """Return a list of human-readable problems with the questions indexes."""
+    inspector = inspect(engine)
+    existing = {index['name'] for index in inspector.get_indexes('questions')}
+    problems = [
+        f'missing index {name} on questions ({", ".join(columns)})'
+        for name, columns in expected_indexes(engine.dialect.name).items()
+        if name not in existing
+    ]
+    if not any(fk['referred_table'] == 'categories'
+               for fk in inspector.get_foreign_keys('questions')):
+        problems.append('missing foreign key questions.category '
+                        '-> categories.id')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='trivia schema migrations')
+    parser.add_argument('command', choices=['upgrade', 'status', 'check'])
+    parser.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL', database_path))
+    args = parser.parse_args(argv)
+    engine = create_engine(args.database_url)
+
+    if args.command == 'upgrade':
+        for migration in upgrade(engine):
+            print(f'applied {migration.version:04d} {migration.description}')
+    elif args.command == 'status':
+        applied = applied_versions(engine)
+        for migration in MIGRATIONS:
+            state = 'applied' if migration.version in applied else 'pending'
+            print(f'{migration.version:04d} {state:<8} '
+                  f'{migration.description}')
+    else:
+        problems = missing_indexes(engine)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print('all expected indexes are present')
+
+
+if __name__ == '__main__':
+    main()
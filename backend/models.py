@@ -1,36 +1,140 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from flask import current_app, has_request_context, request
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, \
+    Index, create_engine, func, orm, text
+from sqlalchemy.engine.url import make_url
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
+from reloading import ReloadingCache
+
 database_name = 'trivia'
 database_path = 'postgres://{}@{}/{}'.format('postgres:bugatti430', 'localhost:5432', database_name)
 
-db = SQLAlchemy()
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+"""
+RoutingSession
+    sends the queries of read-only (GET) requests to the 'replica' bind
+    when one is configured; everything else, including any flush, goes
+    to the primary database.
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if 'replica' in (self.app.config.get('SQLALCHEMY_BINDS') or {}) \
+                and not self._flushing \
+                and has_request_context() \
+                and request.method in READ_METHODS:
+            return self.app.extensions['sqlalchemy'].db.get_engine(
+                self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+"""
+engine_options(config, database_path)
+    builds SQLALCHEMY_ENGINE_OPTIONS from the DATABASE_* settings in
+    config.Config. Pool sizing does not apply to SQLite and statement
+    timeouts only to PostgreSQL, so those are skipped elsewhere.
+"""
+def engine_options(config, database_path):
+    options = {}
+    url = make_url(database_path)
+    if url.get_backend_name() != 'sqlite':
+        for option, key in (
+            ('pool_size', 'DATABASE_POOL_SIZE'),
+            ('max_overflow', 'DATABASE_MAX_OVERFLOW'),
+            ('pool_recycle', 'DATABASE_POOL_RECYCLE'),
+            ('pool_timeout', 'DATABASE_POOL_TIMEOUT'),
+            ('pool_pre_ping', 'DATABASE_POOL_PRE_PING'),
+        ):
+            if config.get(key) is not None:
+                options[option] = config[key]
+
+    connect_args = {}
+    if url.get_backend_name() == 'postgresql':
+        if config.get('DATABASE_CONNECT_TIMEOUT') is not None:
+            connect_args['connect_timeout'] = config['DATABASE_CONNECT_TIMEOUT']
+        if config.get('DATABASE_STATEMENT_TIMEOUT_MS') is not None:
+            connect_args['options'] = \
+                '-c statement_timeout={}'.format(
+                    config['DATABASE_STATEMENT_TIMEOUT_MS'])
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. No connection is
+    made here; the schema is only created when SCHEMA_CREATE is set (use
+    `python migrations.py upgrade` otherwise).
 """
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = \
+        engine_options(app.config, database_path)
+    if app.config.get("DATABASE_REPLICA_URI"):
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds["replica"] = app.config["DATABASE_REPLICA_URI"]
+        app.config["SQLALCHEMY_BINDS"] = binds
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if app.config.get("SCHEMA_CREATE"):
+        db.create_all()
 
 """
-Question
+question change listeners
+    callables registered with on_question_change() are called as
+    listener(action, questions) after a write to the questions table is
+    committed. `action` is 'insert', 'delete' or 'reset' (anything may
+    have changed) and `questions` is a list of Question.format() dicts.
+"""
+question_listeners = []
+
+
+def on_question_change(listener):
+    question_listeners.append(listener)
+    return listener
+
+
+def notify_question_change(action, questions=()):
+    for listener in question_listeners:
+        listener(action, questions)
 
 """
+Question
+    with SOFT_DELETE set, delete() only stamps deleted_at and the row is
+    removed later by the purge_deleted job (flaskr.jobs). Reads filter
+    with Question.not_deleted() so tombstones are never served.
+"""
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+        Index('ix_questions_deleted_at', 'deleted_at',
+              postgresql_where=text('deleted_at IS NOT NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(
+        Integer,
+        ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL')
+    )
     difficulty = Column(Integer)
+    deleted_at = Column(DateTime)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -41,13 +145,31 @@ class Question(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify_question_change('insert', [self.format()])
 
     def update(self):
         db.session.commit()
 
     def delete(self):
-        db.session.delete(self)
+        formatted = self.format()
+        if current_app.config.get('SOFT_DELETE'):
+            self.deleted_at = datetime.utcnow()
+        else:
+            db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', [formatted])
+
+    @classmethod
+    def not_deleted(cls):
+        return cls.deleted_at.is_(None)
+
+    @classmethod
+    def get_live(cls, question_id):
+        """Return the question with this id unless it is missing or deleted."""
+        question = cls.query.get(question_id)
+        if question is None or question.deleted_at is not None:
+            return None
+        return question
 
     def format(self):
         return {
@@ -58,6 +180,32 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+"""
+QuestionCount
+    caches SELECT COUNT(*) over questions so pagination does not
+    materialise the table to learn its size. The cached value is invalidated
+    by Question.insert()/delete() and expires after `ttl` seconds so
+    writes made by other worker processes are picked up eventually.
+"""
+class QuestionCount(ReloadingCache):
+
+    def __init__(self, ttl=30):
+        super().__init__(ttl)
+        self._value = None
+
+    def reload(self):
+        self._value = db.session.query(func.count(Question.id)) \
+            .filter(Question.not_deleted()).scalar()
+
+    def __call__(self):
+        self._ensure_loaded()
+        return self._value
+
+
+question_count = QuestionCount()
+on_question_change(lambda action, questions: question_count.invalidate())
+
+
 """
 Category
 
@@ -75,4 +223,97 @@ class Category(db.Model):
         return {
             'id': self.id,
             'type': self.type
-            }
\ No newline at end of file
+            }
+
+"""
+CategoryRegistry
+    serves the (rarely changing) categories table from memory. The table
+    is read once and kept until invalidate() is called or `ttl` seconds
+    have passed, so steady-state requests make no category queries.
+"""
+class CategoryRegistry(ReloadingCache):
+
+    def __init__(self, ttl=600):
+        super().__init__(ttl)
+        self._types = {}
+
+    def reload(self):
+        rows = db.session.query(Category.id, Category.type) \
+            .order_by(Category.id).all()
+        self._types = dict(rows)
+
+    def _load(self):
+        self._ensure_loaded()
+        return self._types
+
+    def ids(self):
+        return list(self._load())
+
+    def count(self):
+        return len(self._load())
+
+    def type_of(self, category_id):
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            return None
+        return self._load().get(category_id)
+
+    def __contains__(self, category_id):
+        return self.type_of(category_id) is not None
+
+
+category_registry = CategoryRegistry()
+
+"""
+QuizResult
+    the outcome of one finished quiz. A category of None is a game played
+    across all categories. Rows are written in batches by
+    flaskr.leaderboard.ResultBuffer rather than one by one.
+"""
+class QuizResult(db.Model):
+    __tablename__ = 'quiz_results'
+
+    id = Column(Integer, primary_key=True)
+    player = Column(String, nullable=False)
+    category = Column(
+        Integer,
+        ForeignKey('categories.id', onupdate='CASCADE', ondelete='CASCADE')
+    )
+    score = Column(Integer, nullable=False)
+    total_questions = Column(Integer, nullable=False)
+    submitted_at = Column(DateTime, nullable=False)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'player': self.player,
+            'category': self.category,
+            'score': self.score,
+            'total_questions': self.total_questions,
+            'submitted_at': self.submitted_at.isoformat()
+            }
+
+
+# leaderboard order: highest score first, then the earliest result
+Index('ix_quiz_results_score',
+      QuizResult.score.desc(), QuizResult.submitted_at)
+Index('ix_quiz_results_category_score',
+      QuizResult.category, QuizResult.score.desc(), QuizResult.submitted_at)
+
+"""
+QuestionStats
+    how often a question has been served in a quiz and answered right or
+    wrong. Rows are upserted in bulk by flaskr.answer_stats.AnswerStats.
+"""
+class QuestionStats(db.Model):
+    __tablename__ = 'question_stats'
+
+    question_id = Column(
+        Integer,
+        ForeignKey('questions.id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True
+    )
+    served = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+    wrong = Column(Integer, nullable=False, default=0)
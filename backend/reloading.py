@@ -0,0 +1,40 @@
+import threading
+import time
+
+
+class ReloadingCache:
+    """Base for in-memory copies of database state rebuilt every `ttl` seconds.
+
+    Subclasses implement reload(), which reads the database and swaps in
+    the new copy. _ensure_loaded() checks freshness without a lock and,
+    once the copy has expired or been invalidated, checks again holding
+    `_lock` before calling reload(), so threads that find it stale at the
+    same time reload it once. Anything else that must not interleave with
+    a reload (applying changes, or writing what the copy counts) takes
+    the same lock.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at = None
+
+    def fresh(self):
+        return self._loaded_at is not None \
+            and time.monotonic() - self._loaded_at < self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self.fresh():
+            return
+        with self._lock:
+            if self.fresh():
+                return
+            self.reload()
+            self._loaded_at = time.monotonic()
+
+    def reload(self):
+        raise NotImplementedError
@@ -0,0 +1,50 @@
+"""
+Export and inspect question snapshots for read-only nodes (see
+flaskr.snapshot and SNAPSHOT_PATH in config.py):
+
+    python snapshot.py export snapshot.bin   # write a snapshot
+    python snapshot.py info snapshot.bin     # describe one
+
+The database defaults to DATABASE_URL or models.database_path; pass
+--database-url to read another one.
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import create_engine
+
+from models import database_path
+from flaskr.snapshot import Snapshot, write_snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='trivia question snapshots')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    export = subcommands.add_parser('export', help='write a snapshot')
+    export.add_argument('path')
+    export.add_argument('--database-url',
+                        default=os.environ.get('DATABASE_URL', database_path))
+    export.add_argument('--version', type=int,
+                        help='snapshot version (default: now, in ms)')
+    info = subcommands.add_parser('info', help='describe a snapshot')
+    info.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        engine = create_engine(args.database_url)
+        with engine.connect() as connection:
+            version, count = write_snapshot(connection, args.path,
+                                            args.version)
+        print(f'wrote snapshot {version} with {count} questions '
+              f'to {args.path}')
+    else:
+        snapshot = Snapshot(args.path)
+        print(f'snapshot {snapshot.version}: {len(snapshot)} questions, '
+              f'{len(snapshot.category_ids)} categories, '
+              f'{os.path.getsize(args.path)} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,151 @@
 import os
 import sys
+import tempfile
+import time
 import unittest
 import json
+from datetime import datetime
 from urllib import response
-from flask_sqlalchemy import SQLAlchemy
+import asyncio
+from flask import Flask, jsonify
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.admission import AdmissionControl
+from flaskr.asgi import TriviaASGI, asyncpg_dsn
+from flaskr.bulk import delete_questions
+from flaskr.cache import RedisCacheBackend
+from flaskr.jobs import purge_deleted
+from flaskr.leaderboard import ResultBuffer
+from flaskr.serialization import dumps
+from flaskr.snapshot import write_snapshot
+import migrations
+from models import db, setup_db, engine_options, Question, Category, category_registry
+
+
+class StandInRedis:
+    """The subset of a redis-py client used by RedisCacheBackend."""
+
+    def __init__(self):
+        self.values = {}
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1).encode()
+        return int(self.values[key])
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class StandInPool:
+    """The subset of an asyncpg pool used by flaskr.asgi.
+
+    Queries are answered from `categories` and `questions` by looking at
+    the statement; fetchrow() can be held back with `gate` and finds no
+    row for the ids in `deleted`, like a row deleted after the quiz index
+    was loaded.
+    """
+
+    def __init__(self, categories=None, questions=None):
+        self.categories = categories or {1: 'Science', 2: 'Art'}
+        self.questions = questions if questions is not None else [
+            {'id': i, 'question': f'question {i}', 'answer': f'answer {i}',
+             'category': i % 2 + 1, 'difficulty': i % 5 + 1,
+             'correct': None, 'wrong': None}
+            for i in range(1, 13)
+        ]
+        self.gate = None
+        self.deleted = set()
+        self.statements = []
+
+    async def fetch(self, sql, *args):
+        self.statements.append(sql)
+        if sql.startswith('SELECT id, type'):
+            return [{'id': category_id, 'type': category_type}
+                    for category_id, category_type
+                    in sorted(self.categories.items())]
+        if sql.startswith('SELECT id, category'):
+            return list(self.questions)
+        if 'WHERE category = $1' in sql:
+            return [q for q in self.questions if q['category'] == args[0]]
+        if 'ILIKE' in sql:
+            term = args[1].lower()
+            return [q for q in self.questions
+                    if term in q['question'].lower()][:args[2]]
+        if 'WHERE id > $1' in sql:
+            return [q for q in self.questions if q['id'] > args[0]][:args[1]]
+        limit, offset = args
+        return self.questions[offset:offset + limit]
+
+    async def fetchval(self, sql, *args):
+        self.statements.append(sql)
+        if 'ILIKE' in sql:
+            term = args[0].strip('%').lower()
+            return sum(term in q['question'].lower() for q in self.questions)
+        return len(self.questions)
+
+    async def fetchrow(self, sql, question_id):
+        self.statements.append(sql)
+        if self.gate is not None:
+            await self.gate.wait()
+        for question in self.questions:
+            if question['id'] == question_id \
+                    and question_id not in self.deleted:
+                return question
+        return None
+
+
+async def asgi_request(app, method, path, body=None, query_string=b'',
+                       client=('127.0.0.1', 50000)):
+    """Send one HTTP request to an ASGI app; returns (status, headers, data)."""
+    messages = [{
+        'type': 'http.request',
+        'body': json.dumps(body).encode() if body is not None else b''
+    }]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app({'type': 'http', 'method': method, 'path': path,
+               'query_string': query_string, 'client': client},
+              receive, send)
+    return sent[0]['status'], dict(sent[0]['headers']), \
+        json.loads(sent[1]['body'])
+
+
+def call_asgi(app, *args, **kwargs):
+    return asyncio.run(asgi_request(app, *args, **kwargs))
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    database_name = "trivia_test"
+    database_path = "postgres://{}@{}/{}".format('postgres:bugatti430','localhost:5432', database_name)
+
+    @classmethod
+    def setUpClass(cls):
+        """Create the schema once for the whole test case."""
+        app = create_app({'SCHEMA_CREATE': True})
+        setup_db(app, cls.database_path)
+
     def setUp(self):
         """Define test variables and initialize app."""
         self.app = create_app()
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}@{}/{}".format('postgres:bugatti430','localhost:5432', self.database_name)
         setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
     
     def tearDown(self):
         """Executed after reach test"""
@@ -62,6 +182,52 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
 
+    def test_fast_json_matches_jsonify_bytes(self):
+        """Test the fast serialiser produces the same bytes as jsonify"""
+        payload = {
+            'success': True,
+            'questions': [{'id': 1, 'question': 'Qu\u00e9?', 'answer': 'a "b"',
+                           'category': 1, 'difficulty': None}],
+            'total_questions': 1
+        }
+        with self.app.test_request_context():
+            self.assertEqual(dumps(payload), jsonify(payload).get_data())
+
+    def test_category_registry_matches_categories_table(self):
+        """Test the in-memory category registry mirrors the database"""
+        with self.app.app_context():
+            category_registry.invalidate()
+            categories = Category.query.order_by(Category.id).all()
+
+            self.assertEqual(
+                category_registry.ids(),
+                [category.id for category in categories]
+            )
+            for category in categories:
+                self.assertEqual(
+                    category_registry.type_of(category.id),
+                    category.type
+                )
+            self.assertIsNone(category_registry.type_of(50000000))
+
+    def test_get_categories_summary(self):
+        """Test per-category question counts and difficulty histograms"""
+        response = self.client().get('/categories/summary')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['categories'])
+        self.assertEqual(
+            sum(category['total_questions'] for category in data['categories']),
+            data['total_questions']
+        )
+        for category in data['categories']:
+            self.assertEqual(
+                sum(category['difficulties'].values()),
+                category['total_questions']
+            )
+
     def test_get_questions(self):
         """Test GET request for fetching all questions"""
         response = self.client().get('/questions?page=1')
@@ -73,7 +239,88 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['categories'])
-        # self.assertTrue(data['current_category'])
+        self.assertTrue(data['current_category'])
+
+    def test_get_questions_conditional_get_returns_304(self):
+        """Test a matching If-None-Match is answered with 304"""
+        response = self.client().get('/questions?page=1')
+        etag = response.headers['ETag']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Last-Modified'])
+
+        response = self.client().get(
+            '/questions?page=1',
+            headers={'If-None-Match': etag}
+        )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_get_questions_if_modified_since(self):
+        """Test If-Modified-Since is answered from the cache's Last-Modified"""
+        last_modified = self.client().get('/questions?page=1') \
+            .headers['Last-Modified']
+
+        response = self.client().get(
+            '/questions?page=1',
+            headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client().get(
+            '/questions?page=1',
+            headers={'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_shared_cache_backend_serves_other_nodes(self):
+        """Test nodes sharing a cache backend share entries and invalidation"""
+        backend = RedisCacheBackend(StandInRedis())
+        node_a = create_app({'CACHE_BACKEND': backend})
+        node_b = create_app({'CACHE_BACKEND': backend})
+        setup_db(node_a, self.database_path)
+        setup_db(node_b, self.database_path)
+
+        response = node_a.test_client().get('/questions?page=1')
+        etag = response.headers['ETag']
+        self.assertTrue(any(key.startswith('trivia:body:')
+                            for key in backend.client.values))
+
+        response = node_b.test_client().get(
+            '/questions?page=1',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        backend.incr('version')
+        response = node_b.test_client().get(
+            '/questions?page=1',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_questions_after_id(self):
+        """Test GET request for questions using the keyset cursor"""
+        response = self.client().get('/questions?after_id=0')
+
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(question['id'] > 0 for question in data['questions']))
+        self.assertIn('next_after_id', data)
+
+    def test_404_for_page_beyond_last_page(self):
+        """Test GET request for a page past the end returns 404"""
+        response = self.client().get('/questions?page=100000')
+
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
 
     # def test_delete_question(self):
     #     """Test DELETE request for question with id"""
@@ -93,6 +340,93 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_bulk_delete_questions_by_id(self):
+        """Test POST request deleting several questions by id at once"""
+        created = json.loads(self.client().post('/questions/submit', json=[
+            {'question': 'Delete me?', 'answer': 'Yes',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Delete me too?', 'answer': 'Yes',
+             'difficulty': 1, 'category': 1},
+        ]).data)
+        ids = [result['question']['id'] for result in created['results']]
+
+        response = self.client().post('/questions/delete', json={
+            'ids': ids + [50000000]
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(sorted(data['deleted']), sorted(ids))
+        self.assertEqual(data['total_deleted'], 2)
+
+    def test_soft_deleted_questions_are_hidden(self):
+        """Test soft-deleted questions are kept but no longer served"""
+        app = create_app({'SOFT_DELETE': True})
+        setup_db(app, self.database_path)
+        client = app.test_client
+        marker = f'Soft deleted {time.time()}'
+        created = json.loads(client().post('/questions/submit', json=[
+            {'question': f'{marker} {n}?', 'answer': 'Yes',
+             'difficulty': 1, 'category': 1}
+            for n in range(2)
+        ]).data)
+        ids = [result['question']['id'] for result in created['results']]
+
+        response = client().post('/questions/delete', json={'ids': ids})
+        self.assertEqual(json.loads(response.data)['total_deleted'], 2)
+        with app.app_context():
+            for question_id in ids:
+                self.assertIsNotNone(Question.query.get(question_id).deleted_at)
+
+        data = json.loads(client().get(f'/questions?after_id={ids[0] - 1}').data)
+        self.assertFalse(set(ids) & {q['id'] for q in data.get('questions', [])})
+
+        response = client().post('/search', json={'searchTerm': marker})
+        self.assertEqual(response.status_code, 404)
+
+        live = [q['id'] for q in json.loads(
+            client().get('/categories/0/questions').data)['questions']]
+        response = client().post('/quiz', json={
+            'quiz_category': {'id': 1},
+            'previous_questions': live
+        })
+        self.assertEqual(response.status_code, 422)
+
+        exported = client().get('/questions/export').data.decode()
+        self.assertNotIn(marker, exported)
+
+    def test_purge_deleted_job_removes_tombstones_in_batches(self):
+        """Test the purge_deleted job removes soft-deleted rows in batches"""
+        created = json.loads(self.client().post('/questions/submit', json=[
+            {'question': f'Purge me {n}?', 'answer': 'Yes',
+             'difficulty': 1, 'category': 1}
+            for n in range(3)
+        ]).data)
+        ids = [result['question']['id'] for result in created['results']]
+        batches = []
+
+        with self.app.app_context():
+            delete_questions(ids, soft=True)
+            result = purge_deleted({'batch_size': 2},
+                                   lambda done, total: batches.append(done))
+
+            self.assertGreaterEqual(result['purged'], 3)
+            self.assertGreaterEqual(len(batches), 2)
+            self.assertTrue(all(done - before <= 2 for before, done
+                                in zip([0] + batches, batches)))
+            self.assertEqual(batches[-1], result['purged'])
+            self.assertEqual(
+                Question.query.filter(Question.id.in_(ids)).count(), 0)
+
+    def test_422_for_bulk_delete_without_criteria(self):
+        """Test a bulk delete must name ids or a filter"""
+        response = self.client().post('/questions/delete', json={})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_submit_question(self):
         """Test POST request to submit a new question"""
         response = self.client().post('/questions/submit', json={
@@ -107,6 +441,59 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
 
+    def test_submit_batch_of_questions(self):
+        """Test POSTing an array creates valid items and reports invalid ones"""
+        response = self.client().post('/questions/submit', json=[
+            {'question': 'Which planet is largest?', 'answer': 'Jupiter',
+             'difficulty': 2, 'category': 1},
+            {'question': 'Impossible?', 'answer': 'Yes',
+             'difficulty': 9, 'category': 1},
+        ])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['results'][0]['success'], True)
+        self.assertTrue(data['results'][0]['question']['id'])
+        self.assertEqual(data['results'][1]['success'], False)
+        self.assertEqual(data['results'][1]['message'], 'maximum difficulty is 5')
+
+    def test_submit_batch_rejects_non_integer_numbers(self):
+        """Test booleans, fractions and out-of-range difficulties are rejected"""
+        response = self.client().post('/questions/submit', json=[
+            {'question': 'Boolean?', 'answer': 'Yes',
+             'difficulty': True, 'category': 1},
+            {'question': 'Fraction?', 'answer': 'Yes',
+             'difficulty': 2.7, 'category': 1},
+            {'question': 'Boolean category?', 'answer': 'Yes',
+             'difficulty': 1, 'category': True},
+            {'question': 'Too easy?', 'answer': 'Yes',
+             'difficulty': 0, 'category': 1},
+        ])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 0)
+        self.assertEqual(
+            [result['message'] for result in data['results']],
+            ['category and difficulty must be integers'] * 3
+            + ['minimum difficulty is 1']
+        )
+
+    def test_submit_batch_rejects_non_string_text(self):
+        """Test a batch item with a null question is reported, not stored"""
+        response = self.client().post('/questions/submit', json=[
+            {'question': None, 'answer': 'Jupiter',
+             'difficulty': 2, 'category': 1},
+        ])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 0)
+        self.assertEqual(data['results'][0]['message'],
+                         'question and answer must be strings')
+
     def test_405_when_submit_question(self):
         """Test GET request to submit a new question endpoint returns 405"""
         response = self.client().get('/questions/submit', json={
@@ -121,6 +508,58 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'method not allowed')
 
+    def test_bulk_import_questions(self):
+        """Test NDJSON bulk import inserts valid rows and reports bad ones"""
+        rows = [
+            {'question': 'Bulk imported question?', 'answer': 'Yes',
+             'category': 1, 'difficulty': 2},
+            {'question': 'Too hard?', 'answer': 'No',
+             'category': 1, 'difficulty': 6},
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows)
+        response = self.client().post(
+            '/questions/import',
+            data=body,
+            content_type='application/x-ndjson'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'][0]['line'], 2)
+
+    def test_bulk_import_reports_lines_that_are_not_utf8(self):
+        """Test bulk import rejects undecodable lines and keeps the rest"""
+        body = (
+            b'question,answer,category,difficulty\n'
+            b'Imported despite a bad neighbour?,Yes,1,2\n'
+            b'Latin-1 caf\xe9?,No,1,2\n'
+        )
+        response = self.client().post(
+            '/questions/import',
+            data=body,
+            content_type='text/csv'
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['errors'],
+                         [{'line': 3, 'error': 'line is not valid UTF-8'}])
+
+    def test_bulk_export_questions_as_csv(self):
+        """Test CSV export streams a header and one row per question"""
+        response = self.client().get('/questions/export?format=csv')
+        lines = response.data.decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertTrue(lines[1:])
+
     def test_search(self):
         """Test search by term endpoint"""
         response = self.client().post('/search', json={'searchTerm': 'orangutan'})
@@ -132,6 +571,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
 
+    def test_search_is_paginated(self):
+        """Test search results are returned one page at a time"""
+        response = self.client().post('/search', json={'searchTerm': 'e', 'page': 1})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['page'], 1)
+        self.assertLessEqual(len(data['questions']), 10)
+        self.assertGreaterEqual(data['total_questions'], len(data['questions']))
+
     def test_404_for_search_term_not_found(self):
         """Test no results for search term returns 404"""
         response = self.client().post('/search', json={'searchTerm': 'rebbeberb'})
@@ -141,6 +591,24 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_429_when_search_rate_limit_exceeded(self):
+        """Test a client over its search rate limit is told to retry later"""
+        app = create_app({'RATE_LIMITS': {'/search': (1, 2)}})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+
+        for _ in range(2):
+            response = client.post('/search', json={'searchTerm': 'title'})
+            self.assertEqual(response.status_code, 200)
+
+        response = client.post('/search', json={'searchTerm': 'title'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'too many requests')
+        self.assertTrue(int(response.headers['Retry-After']) >= 1)
+
     def test_get_questions_by_category(self):
         """Test get questions in specific category"""
         response = self.client().get('/categories/1/questions')
@@ -151,6 +619,27 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['current_category'])
 
+    def test_stream_questions_by_category_as_ndjson(self):
+        """Test category questions can be streamed one per line"""
+        response = self.client().get('/categories/1/questions?stream=ndjson')
+        lines = response.data.decode().splitlines()
+        expected = json.loads(self.client().get('/categories/1/questions').data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), expected['total_questions'])
+        self.assertEqual(json.loads(lines[0]), expected['questions'][0])
+
+    def test_stream_search_as_json(self):
+        """Test a streamed search returns every match in one JSON object"""
+        response = self.client().post('/search?stream=json', json={'searchTerm': 'e'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), data['total_questions'])
+        self.assertTrue(data['current_category'])
+
     def test_get_random_quiz(self):
         """Test get random quiz POST endpoint"""
         response = self.client().post('/quiz', json= {
@@ -163,6 +652,124 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
 
+    def test_get_random_quiz_in_category_excludes_previous(self):
+        """Test quiz questions come from the category and skip previous ids"""
+        previous_questions = [20]
+        response = self.client().post('/quiz', json={
+            'quiz_category': {'id': 1},
+            'previous_questions': previous_questions
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(int(data['question']['category']), 1)
+        self.assertNotIn(data['question']['id'], previous_questions)
+
+    def test_get_random_quiz_near_target_difficulty(self):
+        """Test a quiz request can aim at a difficulty and a streak"""
+        response = self.client().post('/quiz', json={
+            'quiz_category': {'id': 0},
+            'previous_questions': [],
+            'target_difficulty': 1,
+            'streak': 2
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['question'])
+        self.assertEqual(data['target_difficulty'], 2)
+
+    def test_submit_quiz_answer(self):
+        """Test answers are accepted for known questions only"""
+        question = json.loads(
+            self.client().get('/questions').data)['questions'][0]
+        self.assertIn('empirical_difficulty', question)
+
+        response = self.client().post('/quiz/answers', json={
+            'question_id': question['id'],
+            'correct': True
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question_id'], question['id'])
+
+        response = self.client().post('/quiz/answers', json={
+            'question_id': 1000000,
+            'correct': True
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_submit_result_and_read_leaderboard(self):
+        """Test a submitted quiz result shows up on the leaderboard"""
+        response = self.client().post('/results', json={
+            'player': 'test player',
+            'quiz_category': {'id': 1},
+            'score': 1000,
+            'total_questions': 1000
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['rank'], 1)
+
+        response = self.client().get('/leaderboard?category=1&limit=5')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['leaders'][0]['player'], 'test player')
+        self.assertEqual(data['leaders'][0]['score'], 1000)
+
+    def test_422_for_result_scoring_above_total(self):
+        """Test a score higher than the number of questions is rejected"""
+        response = self.client().post('/results', json={
+            'player': 'test player',
+            'score': 6,
+            'total_questions': 5
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_422_for_result_with_malformed_category(self):
+        """Test a quiz_category that is not an object is rejected"""
+        for quiz_category in ('science', 3, [1], {'id': [1]}):
+            response = self.client().post('/results', json={
+                'player': 'test player',
+                'quiz_category': quiz_category,
+                'score': 1,
+                'total_questions': 5
+            })
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['success'], False)
+
+    def test_result_buffer_drops_rows_the_database_rejects(self):
+        """Test one invalid result does not hold up the rest of its batch"""
+        buffer = ResultBuffer(flush_interval=3600)
+        buffer.app = self.app
+        row = {
+            'player': 'test player',
+            'category': None,
+            'score': 1,
+            'total_questions': 5,
+            'submitted_at': datetime.utcnow()
+        }
+        buffer.add(dict(row, player=None))
+        buffer.add(row)
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.pending(), [])
+
     def test_get_random_quiz_with_no_payload_returns_422(self):
         """Test a 422 response for no payload"""
         response = self.client().post('/quiz')
@@ -172,6 +779,410 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_quiz_session_serves_each_question_once(self):
+        """Test a quiz session never repeats a question"""
+        response = self.client().post('/quiz/sessions', json={
+            'quiz_category': {'id': 1}
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        token = data['session_token']
+
+        served = []
+        for _ in range(data['total_questions']):
+            response = self.client().post(f'/quiz/sessions/{token}/next')
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            served.append(data['question']['id'])
+
+        self.assertEqual(len(served), len(set(served)))
+
+        response = self.client().post(f'/quiz/sessions/{token}/next')
+        self.assertEqual(response.status_code, 404)
+
+    def test_quiz_session_is_served_by_other_nodes(self):
+        """Test nodes sharing a cache backend serve each other's sessions"""
+        backend = RedisCacheBackend(StandInRedis())
+        node_a = create_app({'CACHE_BACKEND': backend})
+        node_b = create_app({'CACHE_BACKEND': backend})
+        setup_db(node_a, self.database_path)
+        setup_db(node_b, self.database_path)
+
+        response = node_a.test_client().post('/quiz/sessions', json={
+            'quiz_category': {'id': 1}
+        })
+        data = json.loads(response.data)
+        token = data['session_token']
+
+        served = []
+        nodes = [node_b.test_client(), node_a.test_client()]
+        for i in range(data['total_questions']):
+            response = nodes[i % 2].post(f'/quiz/sessions/{token}/next')
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            served.append(data['question']['id'])
+
+        self.assertEqual(len(served), len(set(served)))
+        response = node_b.test_client().delete(f'/quiz/sessions/{token}')
+        self.assertEqual(response.status_code, 200)
+        response = node_a.test_client().post(f'/quiz/sessions/{token}/next')
+        self.assertEqual(response.status_code, 404)
+
+    def test_404_for_unknown_quiz_session(self):
+        """Test fetching from an unknown session token returns 404"""
+        response = self.client().post('/quiz/sessions/not-a-token/next')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_422_for_malformed_quiz_session_category(self):
+        """Test starting a session with a malformed category returns 422"""
+        for body in ([1], {'quiz_category': [1]},
+                     {'quiz_category': 'science'}):
+            response = self.client().post('/quiz/sessions', json=body)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['success'], False)
+
+    def test_background_job_runs_and_reports_status(self):
+        """Test a queued job is run in the background and reports its result"""
+        app = create_app({'JOBS_WORKERS': 1})
+        setup_db(app, self.database_path)
+        client = app.test_client
+
+        response = client().post('/jobs', json={
+            'type': 'recompute_aggregates'
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(data['job']['type'], 'recompute_aggregates')
+        self.assertTrue(response.headers['Location'].endswith(
+            '/jobs/{}'.format(data['job']['id'])))
+
+        deadline = time.monotonic() + 10
+        while data['job']['status'] not in ('succeeded', 'failed') \
+                and time.monotonic() < deadline:
+            time.sleep(0.1)
+            data = json.loads(client().get(
+                '/jobs/{}'.format(data['job']['id'])).data)
+
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertTrue(data['job']['result']['questions'])
+
+    def test_422_for_unknown_job_type(self):
+        """Test only registered job types can be submitted"""
+        response = self.client().post('/jobs', json={'type': 'unknown'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_metrics_endpoint_reports_routes(self):
+        """Test /metrics exposes request and SQL metrics when enabled"""
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'METRICS_ENABLED': True
+        })
+        client = app.test_client()
+        client.get('/questions?page=1')
+        response = client.get('/metrics')
+        body = response.data.decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count{route="/questions"}', body)
+        self.assertIn('trivia_request_sql_statements_sum{route="/questions"}', body)
+
+    def test_metrics_endpoint_absent_when_disabled(self):
+        """Test /metrics is not routed unless metrics are enabled"""
+        response = self.client().get('/metrics')
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_engine_options_from_config(self):
+        """Test pool and timeout settings are passed to the engine"""
+        options = engine_options({
+            'DATABASE_POOL_SIZE': 20,
+            'DATABASE_MAX_OVERFLOW': 5,
+            'DATABASE_POOL_PRE_PING': True,
+            'DATABASE_STATEMENT_TIMEOUT_MS': 2000
+        }, self.database_path)
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 5)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(
+            options['connect_args']['options'],
+            '-c statement_timeout=2000'
+        )
+
+    def test_replica_serves_get_requests_and_primary_takes_writes(self):
+        """Test GET requests read from the replica and flushes go to the primary"""
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'DATABASE_REPLICA_URI': 'sqlite:///' + replica_path
+        })
+        with app.app_context():
+            replica = db.get_engine(app, bind='replica')
+            migrations.upgrade(replica)
+            replica.execute(Question.__table__.insert(), {
+                'question': 'Only on the replica?', 'answer': 'Yes',
+                'category': None, 'difficulty': 1
+            })
+
+        def count(question):
+            return Question.query.filter_by(question=question).count()
+
+        with app.test_request_context('/questions', method='GET'):
+            self.assertEqual(db.session.get_bind(), replica)
+            self.assertEqual(count('Only on the replica?'), 1)
+            question = Question(question='Written during a GET?',
+                                answer='Yes', category=None, difficulty=1)
+            db.session.add(question)
+            db.session.commit()
+            self.assertEqual(count('Written during a GET?'), 0)
+
+        with app.test_request_context('/questions', method='POST'):
+            self.assertNotEqual(db.session.get_bind(), replica)
+            self.assertEqual(count('Only on the replica?'), 0)
+            self.assertEqual(count('Written during a GET?'), 1)
+            Question.query.filter_by(
+                question='Written during a GET?').delete()
+            db.session.commit()
+
+    def test_snapshot_app_serves_questions_without_database(self):
+        """Test a read-only app built from a snapshot matches the database"""
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+        with self.app.app_context():
+            write_snapshot(db.session.connection(), path)
+        snapshot_app = create_app({'SNAPSHOT_PATH': path})
+
+        expected = json.loads(self.client().get('/questions').data)
+        response = snapshot_app.test_client().get('/questions')
+        data = json.loads(response.data)
+
+        self.assertNotIn('sqlalchemy', snapshot_app.extensions)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, expected)
+
+        response = snapshot_app.test_client().post('/quiz', json={
+            'quiz_category': {'id': 0},
+            'previous_questions': []
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['question'])
+
+    def test_migrations_leave_no_missing_indexes(self):
+        """Test upgrading the schema creates every index the API relies on"""
+        with self.app.app_context():
+            engine = db.engine
+            migrations.upgrade(engine)
+
+            self.assertEqual(migrations.pending_migrations(engine), [])
+            self.assertEqual(migrations.missing_indexes(engine), [])
+
+class AsyncServingTestCase(unittest.TestCase):
+    """flaskr.asgi against a stand-in asyncpg pool (no database needed)"""
+
+    def asgi_app(self, config=None, fallback=None):
+        flask_app = Flask(__name__)
+        flask_app.config.update(config or {})
+        app = TriviaASGI(dict(flask_app.config), fallback,
+                         AdmissionControl(flask_app))
+        app.pool = StandInPool()
+        return app
+
+    def test_asyncpg_dsn(self):
+        """Test SQLAlchemy URIs are turned into asyncpg DSNs"""
+        self.assertEqual(asyncpg_dsn('postgres://u:p@db:5432/trivia'),
+                         'postgresql://u:p@db:5432/trivia')
+        self.assertEqual(
+            asyncpg_dsn('postgresql+psycopg2://u@db/trivia'),
+            'postgresql://u@db/trivia')
+        with self.assertRaises(ValueError):
+            asyncpg_dsn('sqlite:///trivia.db')
+
+    def test_async_routing_without_fallback(self):
+        """Test unknown paths get 404 and wrong methods 405 without Flask"""
+        app = self.asgi_app()
+
+        status, headers, data = call_asgi(app, 'GET', '/nowhere')
+        self.assertEqual(status, 404)
+        self.assertEqual(data['message'], 'resource not found')
+        self.assertEqual(headers[b'content-type'], b'application/json')
+
+        status, _, data = call_asgi(app, 'POST', '/categories')
+        self.assertEqual(status, 405)
+        self.assertEqual(data['success'], False)
+
+    def test_async_routing_hands_other_requests_to_fallback(self):
+        """Test unported paths and methods go to the fallback app"""
+        forwarded = []
+
+        async def fallback(scope, receive, send):
+            forwarded.append((scope['method'], scope['path']))
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b'{}'})
+
+        app = self.asgi_app(fallback=fallback)
+        call_asgi(app, 'GET', '/leaderboard')
+        call_asgi(app, 'GET', '/search')
+        call_asgi(app, 'GET', '/categories')
+
+        self.assertEqual(forwarded, [('GET', '/leaderboard'),
+                                     ('GET', '/search')])
+
+    def test_async_400_for_malformed_json(self):
+        """Test a body that is not JSON is answered with 400"""
+        app = self.asgi_app()
+
+        async def run():
+            messages = [{'type': 'http.request', 'body': b'{not json'}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await app({'type': 'http', 'method': 'POST', 'path': '/quiz',
+                       'query_string': b''}, receive, send)
+            return sent[0]['status']
+
+        self.assertEqual(asyncio.run(run()), 400)
+
+    def test_async_get_categories(self):
+        """Test the async /categories lists category ids"""
+        app = self.asgi_app()
+
+        status, _, data = call_asgi(app, 'GET', '/categories')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {'success': True, 'categories': [1, 2]})
+
+        app = self.asgi_app()
+        app.pool.categories = {}
+        status, _, _ = call_asgi(app, 'GET', '/categories')
+        self.assertEqual(status, 404)
+
+    def test_async_get_questions(self):
+        """Test the async /questions pages by offset and by keyset"""
+        app = self.asgi_app()
+
+        status, _, data = call_asgi(app, 'GET', '/questions',
+                                    query_string=b'page=2')
+        self.assertEqual(status, 200)
+        self.assertEqual([q['id'] for q in data['questions']], [11, 12])
+        self.assertEqual(data['total_questions'], 12)
+        self.assertEqual(data['categories'], [1, 2])
+        self.assertEqual(data['current_category'], 'Art')
+        self.assertIn('empirical_difficulty', data['questions'][0])
+
+        status, _, data = call_asgi(app, 'GET', '/questions',
+                                    query_string=b'after_id=2')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['questions'][0]['id'], 3)
+        self.assertEqual(data['next_after_id'], 12)
+
+        status, _, _ = call_asgi(app, 'GET', '/questions',
+                                 query_string=b'page=3')
+        self.assertEqual(status, 404)
+
+    def test_async_get_questions_by_category(self):
+        """Test the async category listing uses the same ids as Flask"""
+        app = self.asgi_app()
+
+        status, _, data = call_asgi(app, 'GET', '/categories/0/questions')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['current_category'], 'Science')
+        self.assertEqual(data['total_questions'], 6)
+        self.assertTrue(all(q['category'] == 1 for q in data['questions']))
+
+        status, _, _ = call_asgi(app, 'GET', '/categories/5/questions')
+        self.assertEqual(status, 422)
+
+    def test_async_search(self):
+        """Test the async /search answers malformed bodies like Flask"""
+        app = self.asgi_app()
+
+        status, _, data = call_asgi(app, 'POST', '/search',
+                                    {'searchTerm': 'QUESTION 1'})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['total_questions'], 4)
+        self.assertEqual(data['page'], 1)
+        self.assertEqual(data['questions'][0]['id'], 1)
+
+        for body in ({'searchTerm': 'absent'}, {'searchTerm': ''},
+                     {'searchTerm': 5}, {'searchTerm': 'q', 'page': 0},
+                     [1], 'question', None):
+            status, _, data = call_asgi(app, 'POST', '/search', body)
+            self.assertEqual(status, 404, body)
+            self.assertEqual(data['success'], False)
+
+    def test_async_quiz(self):
+        """Test the async /quiz skips previous and deleted questions"""
+        app = self.asgi_app()
+        app.pool.deleted.add(11)
+
+        status, _, data = call_asgi(app, 'POST', '/quiz', {
+            'quiz_category': {'id': 2},
+            'previous_questions': [1, 3, 5, 7]
+        })
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['id'], 9)
+
+        for body in (None, [1], {'previous_questions': []},
+                     {'quiz_category': {'id': 2},
+                      'previous_questions': [1, 3, 5, 7, 9]}):
+            status, _, data = call_asgi(app, 'POST', '/quiz', body)
+            self.assertEqual(status, 422, body)
+
+    def test_rate_limit_applies_to_async_routes(self):
+        """Test the async /search answers 429 once a client's bucket is empty"""
+        app = self.asgi_app({'RATE_LIMITS': {'/search': (0.001, 2)}})
+        body = {'searchTerm': 'question'}
+
+        statuses = [call_asgi(app, 'POST', '/search', body)[0]
+                    for _ in range(3)]
+        status, headers, data = call_asgi(app, 'POST', '/search', body)
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(status, 429)
+        self.assertEqual(data['message'], 'too many requests')
+        self.assertTrue(int(headers[b'retry-after']) >= 1)
+        status, _, _ = call_asgi(app, 'POST', '/search', body,
+                                 client=('10.0.0.2', 50000))
+        self.assertEqual(status, 200)
+
+    def test_concurrency_limit_applies_to_async_routes(self):
+        """Test the async /quiz answers 503 once its cap and queue are full"""
+        app = self.asgi_app({'CONCURRENCY_LIMITS': {'/quiz': (1, 0)}})
+        body = {'quiz_category': {'id': 0}, 'previous_questions': []}
+
+        async def run():
+            app.pool.gate = asyncio.Event()
+            first = asyncio.ensure_future(
+                asgi_request(app, 'POST', '/quiz', body))
+            await asyncio.sleep(0.01)
+            second = await asgi_request(app, 'POST', '/quiz', body)
+            app.pool.gate.set()
+            return [second[0], (await first)[0]]
+
+        self.assertEqual(asyncio.run(run()), [503, 200])
+        self.assertEqual(app.limiters['/quiz'].active, 0)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
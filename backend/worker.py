@@ -0,0 +1,36 @@
+"""
+Run queued background jobs (see flaskr.jobs and POST /jobs):
+
+    python worker.py                 # one job at a time
+    python worker.py --workers 4     # up to four at once
+
+Web processes only queue jobs unless JOBS_WORKERS is set, so run one of
+these per host next to the web server; several may share JOBS_DATABASE.
+"""
+import argparse
+import sys
+
+from flaskr import create_app
+from flaskr.jobs import jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='trivia job worker')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='jobs to run at once (default: 1)')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    create_app({'JOBS_WORKERS': 0})
+    print(f'running jobs from {jobs.queue.path} '
+          f'with {args.workers} worker(s)')
+    try:
+        jobs.work(args.workers)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())